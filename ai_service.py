@@ -1,22 +1,667 @@
 import requests
+import json
 import logging
+import math
 import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
 
+class _CappedRetry(Retry):
+    """Retry que honra Retry-After pero sin esperar más de MAX_RETRY_AFTER segundos"""
+
+    MAX_RETRY_AFTER = float(os.getenv('AI_MAX_RETRY_AFTER', 10))
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.MAX_RETRY_AFTER)
+
+
+class TipsCache:
+    """
+    Caché LRU+TTL de consejos indexada por signos vitales cuantizados
+
+    Lecturas que solo difieren en un latido o unas décimas caen en el mismo
+    bucket. Cada bucket guarda hasta `variants` respuestas distintas: mientras
+    no está completo se pide una nueva a la IA; después se sirven en rotación
+    hasta que el bucket expira.
+    """
+
+    FC_BIN = 5       # bpm
+    SPO2_BIN = 1     # %
+    TEMP_BIN = 0.5   # °C
+
+    def __init__(self, max_entries=256, ttl=600, variants=3):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, fc, spo2, temp, state):
+        """Bucket de unos signos vitales"""
+        return (
+            int(float(fc) // cls.FC_BIN),
+            int(float(spo2) // cls.SPO2_BIN),
+            math.floor(float(temp) / cls.TEMP_BIN),
+            state
+        )
+
+    def get(self, key):
+        """Retorna un consejo en caché, o None si hay que pedir uno nuevo"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry['created'] > self.ttl:
+                del self._entries[key]
+                return None
+            if len(entry['variants']) < self.variants:
+                return None
+
+            self._entries.move_to_end(key)
+            entry['next'] = (entry['next'] + 1) % len(entry['variants'])
+            return entry['variants'][entry['next']]
+
+    def put(self, key, tips):
+        """Añade una variante al bucket"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry['created'] > self.ttl:
+                entry = {'created': time.monotonic(), 'variants': [], 'next': 0}
+                self._entries[key] = entry
+            if len(entry['variants']) < self.variants:
+                entry['variants'].append(tips)
+
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave: solo la primera se
+    ejecuta y las demás esperan y reciben su mismo resultado
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['event'].wait()
+            if call['error']:
+                raise call['error']
+            return {**call['result'], 'coalesced': True}
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+
+
+class CircuitOpenError(Exception):
+    """El circuito hacia OpenRouter está abierto; no se hace la llamada"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker para las llamadas a OpenRouter
+
+    Cerrado: las llamadas pasan y se registra el resultado en una ventana de
+    las últimas `window` llamadas. Si al menos `min_calls` resultados y la
+    proporción de fallos (errores o llamadas más lentas que `slow_seconds`)
+    llega a `error_rate`, se abre durante `cooldown` segundos y las llamadas
+    se rechazan al instante. Pasado ese tiempo queda semiabierto: se deja
+    pasar una sola llamada de prueba que decide si se cierra o se reabre.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, slow_seconds=15, cooldown=30):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self._results = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """True si la llamada puede salir hacia OpenRouter"""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = self.HALF_OPEN
+                self._probing = False
+
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record(self, ok, latency):
+        """Registra el resultado de una llamada que sí salió"""
+        failed = not ok or latency > self.slow_seconds
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    self._state = self.CLOSED
+                    self._results.clear()
+                    logger.info("Circuito de IA cerrado (la llamada de prueba tuvo éxito)")
+                return
+
+            self._results.append(failed)
+            if self._state == self.CLOSED and len(self._results) >= self.min_calls:
+                if sum(self._results) / len(self._results) >= self.error_rate:
+                    self._open()
+
+    def _open(self):
+        """Abre el circuito (requiere self._lock)"""
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        logger.warning(f"Circuito de IA abierto durante {self.cooldown}s")
+
+
+class ModelStats:
+    """Latencias y errores recientes de un modelo"""
+
+    def __init__(self, window=50):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, ok, latency=None):
+        with self._lock:
+            self.outcomes.append(ok)
+            if ok and latency is not None:
+                self.latencies.append(latency)
+
+    def percentile(self, q):
+        """Percentil q (0-1) de las latencias con éxito, o None sin muestras"""
+        with self._lock:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self):
+        with self._lock:
+            if not self.outcomes:
+                return 0.0
+            return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    @property
+    def samples(self):
+        return len(self.latencies)
+
+
+def local_stress_tips(fc, spo2, temp, state):
+    """
+    Consejos de respaldo generados localmente a partir de los signos vitales,
+    para cuando OpenRouter no está disponible
+    """
+    tips = []
+    if fc >= 100:
+        tips.append(f"Tu frecuencia cardíaca está elevada ({fc} bpm). Respira en 4-7-8: "
+                    "inhala 4 segundos, retén 7 y exhala despacio durante 8. Repite 4 veces.")
+    else:
+        tips.append("Haz respiración de caja: inhala 4 segundos, retén 4, exhala 4 y "
+                    "espera 4. Repite durante 2 minutos.")
+
+    if spo2 and spo2 < 95:
+        tips.append(f"Tu oxigenación es algo baja ({spo2}%). Siéntate erguido, abre una "
+                    "ventana o sal a tomar aire fresco unos minutos.")
+    else:
+        tips.append("Levántate y estira cuello, hombros y espalda durante 1-2 minutos.")
+
+    if temp >= 37.5:
+        tips.append(f"Tu temperatura es algo alta ({temp}°C). Bebe agua fresca y "
+                    "busca un lugar más ventilado.")
+    else:
+        tips.append("Bebe un vaso de agua y aleja la vista de la pantalla un momento.")
+
+    tips.append("Si la sensación de estrés no baja o notas síntomas fuertes, "
+                "consulta a un profesional de salud.")
+
+    return '\n'.join(f"{i}. {tip}" for i, tip in enumerate(tips, 1))
+
+
+def estimate_tokens(text):
+    """Estimación barata de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+
+def trim_context(context, budget):
+    """Últimos mensajes de `context` que caben en `budget` tokens"""
+    kept = []
+    used = 0
+    for msg in reversed(context):
+        used += estimate_tokens(str(msg.get('content', '')))
+        if used > budget:
+            break
+        kept.append(msg)
+    return kept[::-1]
+
+
+class ChatSessions:
+    """
+    Historial de chat por sesión, guardado en el servidor (LRU acotado)
+
+    El contexto enviado a la IA tiene tamaño constante: los turnos recientes
+    caben en `context_tokens` y los más antiguos se condensan en un resumen
+    que nunca supera `summary_tokens`.
+    """
+
+    SUMMARY_LINE_CHARS = 120
+
+    def __init__(self, max_sessions=500, context_tokens=600, summary_tokens=200):
+        self.max_sessions = max_sessions
+        self.context_tokens = context_tokens
+        self.summary_tokens = summary_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, session_id):
+        """Sesión existente o nueva (requiere self._lock)"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = {'summary': '', 'turns': []}
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def context(self, session_id):
+        """Mensajes de contexto para la próxima petición"""
+        with self._lock:
+            session = self._get(session_id)
+            messages = []
+            if session['summary']:
+                messages.append({
+                    'role': 'system',
+                    'content': f"Resumen de la conversación anterior:\n{session['summary']}"
+                })
+            return messages + list(session['turns'])
+
+    def append(self, session_id, message, response):
+        """Registra un intercambio y condensa los turnos que no caben"""
+        with self._lock:
+            session = self._get(session_id)
+            session['turns'] += [
+                {'role': 'user', 'content': message},
+                {'role': 'assistant', 'content': response}
+            ]
+
+            # Condensar por pares usuario/asistente para no romper la alternancia
+            while (len(session['turns']) > 2 and
+                   sum(estimate_tokens(t['content']) for t in session['turns']) > self.context_tokens):
+                summary = session['summary']
+                for old in session['turns'][:2]:
+                    line = old['content'].replace('\n', ' ')[:self.SUMMARY_LINE_CHARS]
+                    summary = f"{summary}\n- {old['role']}: {line}".strip()
+                del session['turns'][:2]
+                # Conservar la parte más reciente del resumen
+                session['summary'] = summary[-self.summary_tokens * 4:]
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
 class AIService:
     """Servicio para interactuar con OpenRouter API"""
 
     def __init__(self):
         self.api_key = os.getenv("OPENROUTER_API_KEY")
-        self.base_url = 'https://openrouter.ai/api/v1/chat/completions'
+        self.base_url = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1/chat/completions')
         # Usar el modelo gratuito correcto
         self.model = os.getenv('AI_MODEL', 'openai/gpt-4o-mini')
 
+        # Modelos candidatos: se elige el más rápido de los sanos
+        self.models = [m.strip() for m in os.getenv('AI_MODELS', self.model).split(',') if m.strip()]
+        self.model_stats = {model: ModelStats() for model in self.models}
+        self.max_model_error_rate = float(os.getenv('AI_MODEL_MAX_ERROR_RATE', 0.5))
+
+        # Hedging: si el primer modelo tarda más que su p95, se lanza la misma
+        # petición a un segundo modelo y gana la primera respuesta
+        self.hedge_min_delay = float(os.getenv('AI_HEDGE_MIN_DELAY', 1.0))
+        self.hedge_default_delay = float(os.getenv('AI_HEDGE_DEFAULT_DELAY', 8.0))
+        self.hedge_min_samples = int(os.getenv('AI_HEDGE_MIN_SAMPLES', 5))
+        self.hedges = 0
+
+        # Salud del upstream para /api/ai_test (sin gastar cuota)
+        self.calls = 0
+        self.errors = {}
+        self.last_success = None
+        self.last_error = None
+        self._health_lock = threading.Lock()
+
+        # Prueba en vivo: solo bajo petición, como mucho una cada AI_PROBE_INTERVAL
+        self.probe_interval = float(os.getenv('AI_PROBE_INTERVAL', 300))
+        self.probe_timeout = float(os.getenv('AI_PROBE_TIMEOUT', 10))
+        self._probe_result = None
+        self._probe_lock = threading.Lock()
+
+        # Conexión: pool keep-alive con timeouts separados y reintentos
+        self.pool_size = int(os.getenv('AI_POOL_SIZE', 10))
+        self.timeout = (
+            float(os.getenv('AI_CONNECT_TIMEOUT', 5)),
+            float(os.getenv('AI_READ_TIMEOUT', 30))
+        )
+        self.max_retries = int(os.getenv('AI_MAX_RETRIES', 2))
+        self.session = self._build_session()
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='ai-hedge')
+
+        # Caché de consejos por signos vitales cuantizados
+        self.tips_cache = TipsCache(
+            max_entries=int(os.getenv('AI_TIPS_CACHE_SIZE', 256)),
+            ttl=float(os.getenv('AI_TIPS_CACHE_TTL', 600)),
+            variants=int(os.getenv('AI_TIPS_VARIANTS', 3))
+        )
+
+        # Peticiones idénticas simultáneas (varios dashboards) -> una sola llamada
+        self.inflight = SingleFlight()
+
+        # Presupuesto de tokens del contexto de chat (historial + resumen)
+        self.context_tokens = int(os.getenv('AI_CHAT_CONTEXT_TOKENS', 800))
+
+        # Dejar de llamar a OpenRouter mientras falla o va demasiado lento
+        self.breaker = CircuitBreaker(
+            window=int(os.getenv('AI_BREAKER_WINDOW', 20)),
+            min_calls=int(os.getenv('AI_BREAKER_MIN_CALLS', 5)),
+            error_rate=float(os.getenv('AI_BREAKER_ERROR_RATE', 0.5)),
+            slow_seconds=float(os.getenv('AI_BREAKER_SLOW_SECONDS', 15)),
+            cooldown=float(os.getenv('AI_BREAKER_COOLDOWN', 30))
+        )
+
         if not self.api_key:
             logger.warning("OPENROUTER_API_KEY no configurada")
 
+    def _build_session(self):
+        """
+        Sesión HTTP compartida por todas las peticiones a OpenRouter
+
+        Reutiliza conexiones TLS (keep-alive) y reintenta 429/5xx y errores de
+        conexión con backoff exponencial con jitter, respetando Retry-After.
+        Un timeout de lectura no se reintenta: el POST ya llegó al modelo y
+        repetirlo duplica el costo y la espera.
+        """
+        retry = _CappedRetry(
+            total=self.max_retries,
+            read=False,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'POST'}),
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+            'HTTP-Referer': 'https://github.com/biometric-monitor',
+            'X-Title': 'Biometric Monitor'
+        })
+        return session
+
+    def _post(self, payload, stream=False, timeout=None):
+        """
+        POST a OpenRouter a través del circuit breaker
+
+        Raises:
+            CircuitOpenError: Si el circuito está abierto
+            requests.exceptions.RequestException: Errores de red o HTTP
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError()
+
+        start = time.monotonic()
+        try:
+            response = self.session.post(
+                self.base_url,
+                json=payload,
+                timeout=timeout or self.timeout,
+                stream=stream
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.breaker.record(False, time.monotonic() - start)
+            self._record_health(e)
+            raise
+
+        self.breaker.record(True, time.monotonic() - start)
+        self._record_health()
+        return response
+
+    def _record_health(self, error=None):
+        """Cuenta llamadas y errores por tipo (timeout, conexión, HTTP xxx)"""
+        with self._health_lock:
+            self.calls += 1
+            if error is None:
+                self.last_success = time.time()
+                return
+
+            if isinstance(error, requests.exceptions.Timeout):
+                kind = 'timeout'
+            elif getattr(error, 'response', None) is not None:
+                kind = f'http_{error.response.status_code}'
+            else:
+                kind = 'connection'
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            self.last_error = {'time': time.time(), 'type': kind}
+
+    def health(self):
+        """Estado del upstream según las llamadas ya hechas (no llama a la API)"""
+        def ms(value):
+            return round(value * 1000) if value is not None else None
+
+        with self._health_lock:
+            health = {
+                'calls': self.calls,
+                'errors': dict(self.errors),
+                'last_success': self.last_success,
+                'last_error': dict(self.last_error) if self.last_error else None
+            }
+
+        health.update({
+            'breaker': {'state': self.breaker.state, 'rejected': self.breaker.rejected},
+            'hedges': self.hedges,
+            'coalesced': self.inflight.coalesced,
+            'models': {
+                model: {
+                    'p50_ms': ms(stats.percentile(0.5)),
+                    'p95_ms': ms(stats.percentile(0.95)),
+                    'samples': stats.samples,
+                    'error_rate': round(stats.error_rate, 3)
+                }
+                for model, stats in self.model_stats.items()
+            }
+        })
+        return health
+
+    def probe(self):
+        """
+        Prueba mínima en vivo contra OpenRouter (1 token), limitada a una cada
+        `probe_interval` segundos; entre medias se devuelve la última
+
+        Returns:
+            dict: {'success', 'latency_ms', 'error', 'time', 'cached'}
+        """
+        with self._probe_lock:
+            last = self._probe_result
+            if last and time.time() - last['time'] < self.probe_interval:
+                return {**last, 'cached': True}
+
+            result = {'success': False, 'latency_ms': None, 'error': '', 'time': time.time()}
+            if not self.api_key:
+                result['error'] = 'API key no configurada'
+            else:
+                model = self._rank_models()[0]
+                payload = {
+                    'model': model,
+                    'messages': [{'role': 'user', 'content': 'ping'}],
+                    'max_tokens': 1
+                }
+                start = time.monotonic()
+                try:
+                    self._post(payload, timeout=(self.timeout[0], self.probe_timeout))
+                    result['success'] = True
+                    result['latency_ms'] = round((time.monotonic() - start) * 1000)
+                except CircuitOpenError:
+                    result['error'] = 'Circuito abierto'
+                except requests.exceptions.RequestException as e:
+                    result['error'] = str(e)
+
+            self._probe_result = result
+            return {**result, 'cached': False}
+
+    def _rank_models(self):
+        """
+        Modelos ordenados del más rápido al más lento por p50; los que fallan
+        demasiado van al final y los que aún no tienen muestras al principio
+        """
+        def rank(model):
+            stats = self.model_stats[model]
+            unhealthy = stats.error_rate > self.max_model_error_rate
+            return (unhealthy, stats.percentile(0.5) or 0.0)
+
+        return sorted(self.models, key=rank)
+
+    def _hedge_delay(self, model):
+        """Cuánto esperar al primer modelo antes de lanzar la petición de cobertura"""
+        stats = self.model_stats[model]
+        if stats.samples < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, stats.percentile(0.95))
+
+    def _attempt(self, model, payload):
+        """Una petición a un modelo concreto; registra su latencia"""
+        start = time.monotonic()
+        try:
+            data = self._post({**payload, 'model': model}).json()
+        except CircuitOpenError:
+            raise
+        except Exception:
+            self.model_stats[model].record(False)
+            raise
+        self.model_stats[model].record(True, time.monotonic() - start)
+        return data
+
+    def _complete(self, payload):
+        """
+        Petición no streaming con enrutado por latencia y hedging
+
+        Se envía al modelo más rápido. Si no responde en su p95 (o falla), se
+        envía la misma petición al siguiente y se usa la primera respuesta
+        válida. La petición perdedora no se puede interrumpir a mitad: se
+        descarta su resultado, aunque su latencia sigue contando.
+
+        Returns:
+            dict: JSON de la respuesta
+        """
+        ranked = self._rank_models()
+        primary = ranked[0]
+        if len(ranked) == 1:
+            return self._attempt(primary, payload)
+
+        first = self.executor.submit(self._attempt, primary, payload)
+        done, _ = wait([first], timeout=self._hedge_delay(primary))
+        if done and first.exception() is None:
+            return first.result()
+        if done and isinstance(first.exception(), CircuitOpenError):
+            raise first.exception()
+
+        secondary = ranked[1]
+        self.hedges += 1
+        logger.info(f"Petición de cobertura a {secondary} ({primary} lento o con error)")
+        pending = {first, self.executor.submit(self._attempt, secondary, payload)}
+        error = first.exception() if done else None
+        if done:
+            pending.discard(first)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    @staticmethod
+    def _fallback_tips(fc, spo2, temp, state):
+        return {
+            'success': True,
+            'tips': local_stress_tips(fc, spo2, temp, state),
+            'error': '',
+            'fallback': True
+        }
+
+    def cached_stress_tips(self, fc, spo2, temp, state):
+        """
+        Consejos que se pueden responder sin llamar a la IA (caché o estado no
+        STRESS); None si hace falta una petición a OpenRouter
+        """
+        if not self.api_key or state != "STRESS" or fc == 0:
+            return self.get_stress_tips(fc, spo2, temp, state)
+
+        cached = self.tips_cache.get(TipsCache.key(fc, spo2, temp, state))
+        if cached:
+            return {'success': True, 'tips': cached, 'error': '', 'cached': True}
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return self._fallback_tips(fc, spo2, temp, state)
+        return None
+
     def get_stress_tips(self, fc, spo2, temp, state):
         """
         Genera consejos para manejar el estrés basado en datos biométricos
@@ -53,6 +698,25 @@ class AIService:
                 'error': ''
             }
 
+        cache_key = TipsCache.key(fc, spo2, temp, state)
+        cached = self.tips_cache.get(cache_key)
+        if cached:
+            logger.debug(f"Consejos servidos desde caché (bucket {cache_key})")
+            return {
+                'success': True,
+                'tips': cached,
+                'error': '',
+                'cached': True
+            }
+
+        return self.inflight.do(
+            cache_key,
+            lambda: self._request_stress_tips(fc, spo2, temp, state, cache_key)
+        )
+
+    def _request_stress_tips(self, fc, spo2, temp, state, cache_key):
+        """Pide los consejos a OpenRouter y los guarda en caché"""
+
         # Construir prompt
         prompt = f"""Eres un asistente de bienestar personal. Un usuario tiene los siguientes datos biométricos:
 
@@ -78,13 +742,6 @@ IMPORTANTE:
 Formato: Lista numerada simple."""
 
         try:
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'HTTP-Referer': 'https://github.com/biometric-monitor',
-                'X-Title': 'Biometric Monitor'
-            }
-
             payload = {
                 'model': self.model,
                 'messages': [
@@ -103,20 +760,13 @@ Formato: Lista numerada simple."""
 
             logger.info(f"Solicitando consejos de IA (FC: {fc}, Estado: {state})")
 
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-
-            response.raise_for_status()
-            data = response.json()
+            data = self._complete(payload)
 
             if 'choices' in data and len(data['choices']) > 0:
                 tips = data['choices'][0]['message']['content'].strip()
 
                 logger.info("Consejos de IA generados exitosamente")
+                self.tips_cache.put(cache_key, tips)
 
                 return {
                     'success': True,
@@ -131,13 +781,13 @@ Formato: Lista numerada simple."""
                     'tips': ''
                 }
 
+        except CircuitOpenError:
+            logger.info("Circuito de IA abierto: consejos generados localmente")
+            return self._fallback_tips(fc, spo2, temp, state)
+
         except requests.exceptions.Timeout:
             logger.error("Timeout al conectar con OpenRouter")
-            return {
-                'success': False,
-                'error': 'La solicitud tardó demasiado. Intenta nuevamente.',
-                'tips': ''
-            }
+            return self._fallback_tips(fc, spo2, temp, state)
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Error en solicitud a OpenRouter: {e}")
@@ -152,7 +802,11 @@ Formato: Lista numerada simple."""
                     error_msg = 'Límite de peticiones excedido. Intenta en unos minutos'
                 elif e.response.status_code >= 500:
                     error_msg = 'Error en el servidor de IA. Intenta nuevamente'
-            
+
+            # Un 401 es un problema de configuración: mejor mostrarlo que ocultarlo
+            if getattr(e.response, 'status_code', None) != 401:
+                return self._fallback_tips(fc, spo2, temp, state)
+
             return {
                 'success': False,
                 'error': error_msg,
@@ -168,13 +822,42 @@ Formato: Lista numerada simple."""
                 'tips': ''
             }
 
-    def chat(self, message, context=None):
+    def _read_stream(self, response, on_token):
+        """
+        Lee una respuesta `stream: true` (Server-Sent Events estilo OpenAI),
+        llamando a on_token con cada fragmento
+
+        Returns:
+            str: Texto completo
+        """
+        # text/event-stream sin charset haría que requests asuma latin-1
+        response.encoding = 'utf-8'
+        parts = []
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                # Ignorar líneas vacías y comentarios (": OPENROUTER PROCESSING")
+                if not line or not line.startswith('data:'):
+                    continue
+                chunk = line[5:].strip()
+                if chunk == '[DONE]':
+                    break
+
+                choices = json.loads(chunk).get('choices') or [{}]
+                token = (choices[0].get('delta') or {}).get('content')
+                if token:
+                    parts.append(token)
+                    on_token(token)
+        return ''.join(parts)
+
+    def chat(self, message, context=None, on_token=None):
         """
         Chat conversacional con el usuario
 
         Args:
             message: Mensaje del usuario
             context: Lista de mensajes previos [{'role': 'user/assistant', 'content': '...'}]
+            on_token: Si se indica, la respuesta se pide en modo streaming y se
+                llama on_token(str) con cada fragmento según llega
 
         Returns:
             dict: {'success': bool, 'response': str, 'error': str}
@@ -195,13 +878,6 @@ Formato: Lista numerada simple."""
             }
 
         try:
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'HTTP-Referer': 'https://github.com/biometric-monitor',
-                'X-Title': 'Biometric Monitor'
-            }
-
             # Construir historial de mensajes
             messages = [
                 {
@@ -218,9 +894,9 @@ Formato: Lista numerada simple."""
                 }
             ]
 
-            # Añadir contexto si existe (máximo 5 mensajes previos)
+            # Añadir contexto si existe (los mensajes más recientes que quepan)
             if context and isinstance(context, list):
-                messages.extend(context[-5:])
+                messages.extend(trim_context(context, self.context_tokens))
 
             # Añadir mensaje actual
             messages.append({
@@ -234,18 +910,40 @@ Formato: Lista numerada simple."""
                 'max_tokens': 200,
                 'temperature': 0.8
             }
+            if on_token:
+                payload['stream'] = True
 
             logger.info(f"Chat request: {message[:50]}...")
 
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            if on_token:
+                # En streaming los fragmentos ya enviados no se pueden deshacer:
+                # sin hedging, solo el modelo más rápido
+                model = self._rank_models()[0]
+                payload['model'] = model
+                try:
+                    response = self._post(payload, stream=True)
+                except requests.exceptions.RequestException:
+                    self.model_stats[model].record(False)
+                    raise
+                # Solo el resultado: el tiempo hasta las cabeceras no es comparable
+                self.model_stats[model].record(True)
+
+                ai_response = self._read_stream(response, on_token).strip()
+                if ai_response:
+                    logger.info("Respuesta de chat generada (streaming)")
+                    return {
+                        'success': True,
+                        'response': ai_response,
+                        'error': ''
+                    }
+                logger.error("Respuesta en streaming vacía")
+                return {
+                    'success': False,
+                    'error': 'Respuesta inválida de la API',
+                    'response': ''
+                }
 
-            response.raise_for_status()
-            data = response.json()
+            data = self._complete(payload)
 
             if 'choices' in data and len(data['choices']) > 0:
                 ai_response = data['choices'][0]['message']['content'].strip()
@@ -265,6 +963,13 @@ Formato: Lista numerada simple."""
                     'response': ''
                 }
 
+        except CircuitOpenError:
+            return {
+                'success': False,
+                'error': 'El servicio de IA no está disponible en este momento. Intenta en unos segundos.',
+                'response': ''
+            }
+
         except requests.exceptions.Timeout:
             return {
                 'success': False,
@@ -10,16 +10,38 @@ Este servidor corre en la nube (Render, Railway, etc.) y:
 No requiere Bluetooth - los datos llegan desde el gateway local.
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, session
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 import logging
 import sys
 import os
+import io
+import json
+import zlib
+import math
+import time
+import mmap
+import signal
+import atexit
+import struct
+import uuid
+import threading
+from array import array
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+try:
+    import zstandard
+
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+import wire_format
+
 load_dotenv()
 
 # Configuración de logging
@@ -40,7 +62,7 @@ socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # Importar servicios
 try:
-    from ai_service import AIService
+    from ai_service import AIService, TipsCache, ChatSessions
     ai_service = AIService()
     logger.info("✓ Servicio de IA inicializado")
 except Exception as e:
@@ -69,26 +91,111 @@ class DataStore:
         self.gateways = {}
         self.gateway_last_seen = {}
         
+        # Gateways conectados por Socket.IO (sid -> gateway_id); la conexión
+        # abierta cuenta como señal de vida, sin necesidad de pings HTTP
+        self.gateway_sockets = {}
+        
+        # Clientes web conectados (sid -> gateway_id observado, None = todos)
+        self.watchers = {}
+        
+        # Última lectura de cada sensor de gateways multi-sensor
+        # ('gateway_id/device_id' -> lectura)
+        self.devices = {}
+        
+        # Buffers de gráfica de cada sensor ('gateway_id/device_id' ->
+        # (fc, spo2, temp, timestamps)); el dato actual y los buffers globales
+        # siguen a un solo sensor para no saltar entre pacientes
+        self.device_buffers = {}
+        self.focus_device = None
+        
         # Historial de alertas
         self.alerts = deque(maxlen=50)
         
-    def update(self, data):
-        """Actualiza los datos actuales"""
-        self.current_data.update({
-            'fc': data.get('fc', 0),
-            'spo2': data.get('spo2', 0),
-            'temp': data.get('temp', 0.0),
-            'state': data.get('state', 'SIN_DEDO'),
-            'timestamp': data.get('timestamp', datetime.now().isoformat())
-        })
+        # Últimas seq aplicadas por gateway y época de su outbox
+        # ((gateway_id, epoch) -> (set, deque)), para descartar lotes
+        # reenviados cuyo ack se perdió
+        self.recent_seqs = {}
+        self.max_recent_seqs = 4096
+        
+        # Protege buffers y alertas entre la ingesta, los snapshots y las lecturas
+        # (reentrante: el snapshot de SIGTERM corre en el hilo principal)
+        self.lock = threading.RLock()
+        
+    def update(self, data, gateway_id=None):
+        """Actualiza los datos actuales y retorna la alerta generada (o None)"""
+        # Lecturas etiquetadas con su sensor: el estado anterior es el de ese
+        # mismo sensor, no el de la última lectura de cualquiera
+        device_id = data.get('device_id')
+        device_key = None
+        if device_id is not None:
+            gateway_id = gateway_id or data.get('gateway_id')
+            device_key = f'{gateway_id}/{device_id}'
+            previous_state = self.devices.get(device_key, {}).get('state')
+        else:
+            previous_state = self.current_data.get('state')
+        
+        # El dashboard sigue las lecturas sin sensor o, si no hay, al primer sensor visto
+        if device_key and self.focus_device is None:
+            self.focus_device = device_key
+        
+        if device_key is None or device_key == self.focus_device:
+            self.current_data.update({
+                'fc': data.get('fc', 0),
+                'spo2': data.get('spo2', 0),
+                'temp': data.get('temp', 0.0),
+                'state': data.get('state', 'SIN_DEDO'),
+                'timestamp': data.get('timestamp', datetime.now().isoformat())
+            })
+            self._append_point((self.fc_buffer, self.spo2_buffer, self.temp_buffer, self.timestamps), data)
+        
+        if device_key:
+            buffers = self.device_buffers.get(device_key)
+            if buffers is None:
+                buffers = self.device_buffers[device_key] = self._new_buffers()
+            self._append_point(buffers, data)
+            self.devices[device_key] = {
+                'gateway_id': gateway_id,
+                'device_id': device_id,
+                'fc': data.get('fc', 0),
+                'spo2': data.get('spo2', 0),
+                'temp': data.get('temp', 0.0),
+                'state': data.get('state', 'SIN_DEDO'),
+                'timestamp': data.get('timestamp')
+            }
         
-        # Actualizar buffers
-        self.fc_buffer.append(data.get('fc', 0))
-        self.spo2_buffer.append(data.get('spo2', 0))
-        self.temp_buffer.append(data.get('temp', 0.0))
+        # Detectar alertas
+        alert = self._check_alerts(data, previous_state)
+        if alert and device_key:
+            alert['gateway_id'] = gateway_id
+            alert['device_id'] = device_id
+            alert['message'] += f' ({device_id})'
+        return alert
+    
+    def _new_buffers(self):
+        """Buffers vacíos (fc, spo2, temp, timestamps) para un sensor"""
+        return tuple(deque(maxlen=self.max_points) for _ in range(4))
+    
+    def _append_point(self, buffers, data):
+        """Añade una lectura a unos buffers (fc, spo2, temp, timestamps)"""
+        fc, spo2, temp, timestamps = buffers
+        
+        # El gateway omitió lecturas iguales a la anterior (banda muerta):
+        # se repite el último valor de estos mismos buffers hasta held_until
+        # para dibujar el escalón
+        if data.get('held_until') and fc:
+            fc.append(fc[-1])
+            spo2.append(spo2[-1])
+            temp.append(temp[-1])
+            timestamps.append(self._time_label(data['held_until']))
         
-        # Manejar timestamp que puede venir como string o número
-        timestamp_raw = data.get('timestamp', datetime.now().isoformat())
+        fc.append(data.get('fc', 0))
+        spo2.append(data.get('spo2', 0))
+        temp.append(data.get('temp', 0.0))
+        timestamps.append(self._time_label(data.get('timestamp', datetime.now().isoformat())))
+    
+    @staticmethod
+    def _time_label(timestamp_raw):
+        """Etiqueta HH:MM:SS de un timestamp que puede venir como string o número"""
         if isinstance(timestamp_raw, (int, float)):
             # Si es número (Unix timestamp), convertir a datetime
             timestamp_dt = datetime.fromtimestamp(timestamp_raw)
@@ -101,16 +208,27 @@ class DataStore:
         else:
             timestamp_dt = datetime.now()
         
-        self.timestamps.append(timestamp_dt.strftime('%H:%M:%S'))
-        
-        # Detectar alertas
-        self._check_alerts(data)
+        return timestamp_dt.strftime('%H:%M:%S')
     
-    def _check_alerts(self, data):
+    def _check_alerts(self, data, previous_state=None):
         """Detecta y registra alertas"""
         fc = data.get('fc', 0)
         spo2 = data.get('spo2', 0)
         state = data.get('state', 'NORMAL')
+        # Primera lectura en estrés tras RELAX/NORMAL
+        onset = previous_state in ('RELAX', 'NORMAL')
+        
+        if data.get('summary'):
+            # Resumen de un intervalo (gateway en modo agregado): cuentan el
+            # peor valor y cualquier lectura en estrés, no solo la última
+            stats = data.get('stats') or {}
+            states = data.get('states') or {}
+            fc = int(stats.get('fc', {}).get('max', fc))
+            spo2 = int(stats.get('spo2', {}).get('min', spo2))
+            if states.get('STRESS'):
+                # Termina en estrés tras lecturas tranquilas: el episodio empezó aquí
+                onset = onset or (state == 'STRESS' and bool(states.get('RELAX') or states.get('NORMAL')))
+                state = 'STRESS'
         
         alert = None
         
@@ -119,7 +237,8 @@ class DataStore:
                 'type': 'stress',
                 'message': f'Estrés detectado - FC: {fc} bpm',
                 'severity': 'warning',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'stress_onset': onset
             }
         elif spo2 > 0 and spo2 < 90:
             alert = {
@@ -143,15 +262,177 @@ class DataStore:
     
     def get_current(self):
         """Obtiene datos actuales con buffers"""
-        return {
-            **self.current_data,
-            'buffers': {
-                'fc': list(self.fc_buffer),
-                'spo2': list(self.spo2_buffer),
-                'temp': list(self.temp_buffer),
-                'timestamps': list(self.timestamps)
+        with self.lock:
+            devices = {}
+            for device_key, device in self.devices.items():
+                fc, spo2, temp, timestamps = self.device_buffers.get(device_key) or self._new_buffers()
+                devices[device_key] = {
+                    **device,
+                    'buffers': {
+                        'fc': list(fc),
+                        'spo2': list(spo2),
+                        'temp': list(temp),
+                        'timestamps': list(timestamps)
+                    }
+                }
+            return {
+                **self.current_data,
+                'focus_device': self.focus_device,
+                'devices': devices,
+                'buffers': {
+                    'fc': list(self.fc_buffer),
+                    'spo2': list(self.spo2_buffer),
+                    'temp': list(self.temp_buffer),
+                    'timestamps': list(self.timestamps)
+                }
             }
-        }
+    
+    # Snapshot binario: cabecera + arrays de tamaño fijo (fc/spo2 int32,
+    # temp float64, timestamps 'HH:MM:SS' de 8 bytes) + metadatos en JSON +
+    # los mismos arrays de cada sensor, uno tras otro ('device_table' en los
+    # metadatos: clave, offset y número de puntos de cada uno).
+    # Al restaurar, los buffers se copian del mmap sin parsear registro a registro.
+    SNAPSHOT_MAGIC = b'FSNP'
+    SNAPSHOT_VERSION = 2
+    SNAPSHOT_HEADER = struct.Struct('<4sHII')
+    SNAPSHOT_POINT_SIZE = 4 + 4 + 8 + 8
+    
+    @staticmethod
+    def _pack_buffers(buffers):
+        """Bloque binario de unos buffers (fc, spo2, temp, timestamps) y su número de puntos"""
+        fc, spo2, temp, timestamps = buffers
+        stamps = ''.join(f'{t:8.8}' for t in timestamps).encode('ascii', errors='replace')
+        block = b''.join((
+            array('i', (int(v) for v in fc)).tobytes(),
+            array('i', (int(v) for v in spo2)).tobytes(),
+            array('d', (float(v) for v in temp)).tobytes(),
+            stamps
+        ))
+        return block, len(fc)
+    
+    @staticmethod
+    def _unpack_buffers(mm, offset, count):
+        """Arrays (fc, spo2, temp) y timestamps de un bloque de `count` puntos en `offset`"""
+        fc, spo2, temp = array('i'), array('i'), array('d')
+        for buffer in (fc, spo2, temp):
+            size = count * buffer.itemsize
+            buffer.frombytes(mm[offset:offset + size])
+            offset += size
+        stamps = mm[offset:offset + count * 8].decode('ascii')
+        return fc, spo2, temp, [stamps[i:i + 8] for i in range(0, len(stamps), 8)]
+    
+    def save_snapshot(self, path):
+        """Escribe el estado en memoria en `path` de forma atómica"""
+        if not self.lock.acquire(timeout=2):
+            raise TimeoutError('data store ocupado')
+        try:
+            block, count = self._pack_buffers((self.fc_buffer, self.spo2_buffer, self.temp_buffer, self.timestamps))
+            device_blocks = []
+            device_table = []
+            device_offset = 0
+            for device_key, buffers in self.device_buffers.items():
+                device_block, device_count = self._pack_buffers(buffers)
+                device_blocks.append(device_block)
+                device_table.append([device_key, device_offset, device_count])
+                device_offset += len(device_block)
+            meta = json.dumps({
+                'current_data': self.current_data,
+                'devices': self.devices,
+                'device_table': device_table,
+                'focus_device': self.focus_device,
+                'gateways': self.gateways,
+                'gateway_last_seen': {k: v.isoformat() for k, v in self.gateway_last_seen.items()},
+                'alerts': list(self.alerts)
+            }, default=str).encode('utf-8')
+        finally:
+            self.lock.release()
+        
+        # Nombre por proceso: gunicorn corre varios workers sobre el mismo snapshot
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, count, len(meta)))
+            for chunk in (block, meta, *device_blocks):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    
+    def load_snapshot(self, path):
+        """Restaura el estado desde un snapshot; retorna False si no hay uno válido"""
+        if not os.path.exists(path) or os.path.getsize(path) < self.SNAPSHOT_HEADER.size:
+            return False
+        
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, count, meta_len = self.SNAPSHOT_HEADER.unpack_from(mm)
+            # La versión 1 es la misma sin buffers por sensor
+            if magic != self.SNAPSHOT_MAGIC or version not in (1, self.SNAPSHOT_VERSION):
+                logger.warning(f"Snapshot ignorado (formato desconocido): {path}")
+                return False
+            
+            offset = self.SNAPSHOT_HEADER.size
+            points = self._unpack_buffers(mm, offset, count)
+            offset += count * self.SNAPSHOT_POINT_SIZE
+            meta = json.loads(mm[offset:offset + meta_len])
+            offset += meta_len
+            
+            device_points = {}
+            if version == self.SNAPSHOT_VERSION:
+                for device_key, device_offset, device_count in meta.get('device_table', []):
+                    device_points[device_key] = self._unpack_buffers(mm, offset + device_offset, device_count)
+        
+        with self.lock:
+            for buffer, items in zip((self.fc_buffer, self.spo2_buffer, self.temp_buffer, self.timestamps), points):
+                buffer.extend(items)
+            self.current_data.update(meta.get('current_data', {}))
+            self.devices.update(meta.get('devices', {}))
+            for device_key, values in device_points.items():
+                buffers = self.device_buffers[device_key] = self._new_buffers()
+                for buffer, items in zip(buffers, values):
+                    buffer.extend(items)
+            self.focus_device = self.focus_device or meta.get('focus_device')
+            self.gateways.update(meta.get('gateways', {}))
+            self.gateway_last_seen.update({
+                k: datetime.fromisoformat(v) for k, v in meta.get('gateway_last_seen', {}).items()
+            })
+            self.alerts.extend(meta.get('alerts', []))
+        return True
+    
+    def filter_seen(self, gateway_id, samples):
+        """
+        Descarta muestras con una seq ya aplicada para este gateway
+
+        Las seq se comparan dentro de la época del outbox del lote: un
+        gateway con un outbox nuevo vuelve a numerar desde 1.
+
+        Returns:
+            tuple: (muestras nuevas, [primera seq, última seq] del lote o None)
+        """
+        seqs = [s['seq'] for s in samples if isinstance(s, dict) and 'seq' in s]
+        if not seqs:
+            return samples, None
+        
+        epoch = next((s.get('epoch') for s in samples if isinstance(s, dict) and 'seq' in s), None)
+        key = (gateway_id, epoch)
+        
+        with self.lock:
+            if key not in self.recent_seqs:
+                # Las seq de épocas anteriores de este gateway ya no se reenviarán
+                for old_key in [k for k in self.recent_seqs if k[0] == gateway_id]:
+                    del self.recent_seqs[old_key]
+            seen, order = self.recent_seqs.setdefault(key, (set(), deque()))
+            fresh = []
+            for sample in samples:
+                seq = sample.get('seq') if isinstance(sample, dict) else None
+                if seq is None:
+                    fresh.append(sample)
+                    continue
+                if seq in seen:
+                    continue
+                seen.add(seq)
+                order.append(seq)
+                if len(order) > self.max_recent_seqs:
+                    seen.discard(order.popleft())
+                fresh.append(sample)
+        
+        return fresh, [min(seqs), max(seqs)]
     
     def register_gateway(self, gateway_id, info):
         """Registra un nuevo gateway"""
@@ -162,13 +443,131 @@ class DataStore:
     def update_gateway_ping(self, gateway_id):
         """Actualiza último ping de gateway"""
         self.gateway_last_seen[gateway_id] = datetime.now()
+    
+    def attach_gateway_socket(self, sid, gateway_id):
+        """Asocia una conexión Socket.IO a un gateway"""
+        self.gateway_sockets[sid] = gateway_id
+        self.gateway_last_seen[gateway_id] = datetime.now()
+    
+    def detach_gateway_socket(self, sid):
+        """Elimina una conexión Socket.IO y retorna el gateway asociado"""
+        gateway_id = self.gateway_sockets.pop(sid, None)
+        if gateway_id:
+            self.gateway_last_seen[gateway_id] = datetime.now()
+        return gateway_id
+    
+    def add_watcher(self, sid, gateway_id=None):
+        """Registra un cliente web que observa un gateway (o todos)"""
+        self.watchers[sid] = gateway_id
+    
+    def remove_watcher(self, sid):
+        """Elimina un cliente web"""
+        self.watchers.pop(sid, None)
+    
+    def is_watched(self, gateway_id):
+        """Indica si algún cliente web está mirando los datos de este gateway"""
+        return any(watched in (None, gateway_id) for watched in list(self.watchers.values()))
+    
+    def connected_gateways(self):
+        """Cuenta gateways vivos: con socket abierto o vistos por HTTP hace < 2 min"""
+        now = datetime.now()
+        alive = set(list(self.gateway_sockets.values()))
+        for gateway_id, last_seen in list(self.gateway_last_seen.items()):
+            if now - last_seen < timedelta(minutes=2):
+                alive.add(gateway_id)
+        return len(alive)
+
+class IngestMeter:
+    """Tasa de ingesta (muestras/s) con media móvil exponencial"""
+    
+    def __init__(self, half_life=10.0):
+        self.half_life = half_life
+        self._rate = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _decay(self, now):
+        elapsed = now - self._last
+        self._last = now
+        return 0.5 ** (elapsed / self.half_life)
+    
+    def add(self, count):
+        """Suma `count` muestras recibidas ahora"""
+        with self._lock:
+            decay = self._decay(time.monotonic())
+            self._rate = self._rate * decay + count * math.log(2) / self.half_life
+    
+    def rate(self):
+        """Muestras por segundo estimadas"""
+        with self._lock:
+            self._rate *= self._decay(time.monotonic())
+            return self._rate
+
 
 # Instancia global del data store
 data_store = DataStore()
+ingest_meter = IngestMeter()
+
+# ==================== SNAPSHOTS DEL ESTADO ====================
+# Render (plan free) duerme y reinicia el servicio; el estado en memoria se
+# guarda periódicamente y al recibir SIGTERM, y se restaura al arrancar.
+
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'filsync_snapshot.bin')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 30))
+
+
+def save_snapshot():
+    """Guarda el snapshot sin propagar errores (se llama desde hilos y señales)"""
+    try:
+        data_store.save_snapshot(SNAPSHOT_PATH)
+    except Exception as e:
+        logger.error(f"Error guardando snapshot: {e}")
+
+
+def _snapshot_loop():
+    while True:
+        socketio.sleep(SNAPSHOT_INTERVAL)
+        save_snapshot()
+
+
+def _install_sigterm_snapshot():
+    """Guarda un snapshot en SIGTERM y luego delega en el manejador previo"""
+    previous = signal.getsignal(signal.SIGTERM)
+    
+    def handle_sigterm(signum, frame):
+        logger.info("SIGTERM recibido, guardando snapshot...")
+        save_snapshot()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            sys.exit(0)
+    
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:
+        # Solo se puede instalar desde el hilo principal
+        logger.debug("No se pudo instalar el manejador de SIGTERM")
+
+
+if SNAPSHOT_INTERVAL > 0:
+    started = time.perf_counter()
+    try:
+        if data_store.load_snapshot(SNAPSHOT_PATH):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            logger.info(f"✓ Estado restaurado desde {SNAPSHOT_PATH} en {elapsed_ms:.1f} ms")
+    except Exception as e:
+        logger.warning(f"No se pudo restaurar el snapshot: {e}")
+    
+    _install_sigterm_snapshot()
+    atexit.register(save_snapshot)
+    socketio.start_background_task(_snapshot_loop)
 
 # Clave secreta para autenticar gateways
 GATEWAY_SECRET = os.getenv('GATEWAY_SECRET_KEY', 'default-secret-change-me')
 
+# Namespace Socket.IO de los gateways
+GATEWAY_NAMESPACE = '/gateway'
+
 def verify_gateway_auth():
     """Verifica que la petición viene de un gateway autorizado"""
     secret = request.headers.get('X-Gateway-Secret')
@@ -177,6 +576,284 @@ def verify_gateway_auth():
         return False
     return True
 
+# Tamaño máximo del cuerpo ya descomprimido (protege contra "zip bombs")
+MAX_GATEWAY_BODY = int(os.getenv('MAX_GATEWAY_BODY', 4 * 1024 * 1024))
+
+# Codificaciones aceptadas en Content-Encoding
+GATEWAY_ENCODINGS = ['gzip', 'zstd'] if ZSTD_AVAILABLE else ['gzip']
+
+
+class GatewayPayloadError(ValueError):
+    """Cuerpo de gateway inválido; lleva el código HTTP a responder"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _decompress_body(raw, encoding):
+    """Descomprime el cuerpo según Content-Encoding sin pasar de MAX_GATEWAY_BODY"""
+    if encoding in ('', 'identity'):
+        body = raw
+    elif encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            body = decompressor.decompress(raw, MAX_GATEWAY_BODY + 1)
+        except zlib.error as e:
+            raise GatewayPayloadError(f'gzip inválido: {e}')
+    elif encoding == 'zstd' and ZSTD_AVAILABLE:
+        try:
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw))
+            body = reader.read(MAX_GATEWAY_BODY + 1)
+        except zstandard.ZstdError as e:
+            raise GatewayPayloadError(f'zstd inválido: {e}')
+    else:
+        raise GatewayPayloadError(f'Content-Encoding no soportado: {encoding}', 415)
+
+    if len(body) > MAX_GATEWAY_BODY:
+        raise GatewayPayloadError('Cuerpo demasiado grande', 413)
+    return body
+
+
+def _read_gateway_body():
+    """Lee el cuerpo de un gateway ya descomprimido (gzip y, si está instalado, zstd)"""
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    return _decompress_body(request.get_data(cache=False), encoding)
+
+
+def get_gateway_json():
+    """Lee el JSON enviado por un gateway"""
+    try:
+        return json.loads(_read_gateway_body())
+    except ValueError as e:
+        if isinstance(e, GatewayPayloadError):
+            raise
+        raise GatewayPayloadError('JSON inválido')
+
+
+def get_gateway_samples():
+    """
+    Lee las muestras enviadas por un gateway
+
+    El formato se negocia con Content-Type: JSON (objeto o lista) o el
+    formato binario de wire_format.
+
+    Returns:
+        tuple: (gateway_id o None, lista de dicts)
+    """
+    if request.mimetype == wire_format.CONTENT_TYPE:
+        try:
+            gateway_id, samples = wire_format.decode_samples(_read_gateway_body())
+        except wire_format.UnsupportedVersionError as e:
+            raise GatewayPayloadError(str(e), 415)
+        except wire_format.WireFormatError as e:
+            raise GatewayPayloadError(str(e))
+        return gateway_id or None, samples
+
+    payload = get_gateway_json()
+    samples = payload if isinstance(payload, list) else [payload]
+    return samples_gateway_id(samples), samples
+
+
+def samples_gateway_id(samples):
+    """gateway_id de un lote JSON (lo lleva cada muestra) o del query string"""
+    if samples and isinstance(samples[0], dict) and samples[0].get('gateway_id'):
+        return samples[0]['gateway_id']
+    return request.args.get('gateway_id')
+
+
+def gateway_payload_error_response(error):
+    """Respuesta JSON para un GatewayPayloadError"""
+    logger.warning(f"Payload de gateway rechazado desde {request.remote_addr}: {error}")
+    response = jsonify({'success': False, 'error': str(error)})
+    if error.status == 415:
+        response.headers['Accept-Encoding'] = ', '.join(GATEWAY_ENCODINGS)
+        response.headers['Accept'] = f'application/json, {wire_format.CONTENT_TYPE}'
+    return response, error.status
+
+
+# ==================== CONTROL ADAPTATIVO DE GATEWAYS ====================
+# El servidor indica a cada gateway su ritmo de envío, tamaño de lote y si
+# quiere datos crudos o resumidos, según la carga y si alguien lo observa.
+# Se entrega en la cabecera X-Filsync-Control de la ingesta HTTP, en el ack
+# de Socket.IO y como evento 'control' cuando cambian los observadores.
+
+MAX_INGEST_RATE = float(os.getenv('MAX_INGEST_RATE', 200))
+
+CONTROL_WATCHED = {
+    'mode': 'raw',
+    'send_interval_ms': int(os.getenv('CONTROL_WATCHED_INTERVAL_MS', 250)),
+    'batch_size': int(os.getenv('CONTROL_WATCHED_BATCH', 10))
+}
+CONTROL_OVERLOADED = {
+    'mode': 'raw',
+    'send_interval_ms': int(os.getenv('CONTROL_OVERLOADED_INTERVAL_MS', 2000)),
+    'batch_size': int(os.getenv('CONTROL_OVERLOADED_BATCH', 100))
+}
+CONTROL_UNWATCHED = {
+    'mode': 'summary',
+    'send_interval_ms': int(os.getenv('CONTROL_UNWATCHED_INTERVAL_MS', 10000)),
+    'batch_size': int(os.getenv('CONTROL_UNWATCHED_BATCH', 100))
+}
+
+
+def gateway_control(gateway_id):
+    """Parámetros de envío que debe usar un gateway ahora mismo"""
+    if not data_store.is_watched(gateway_id):
+        control = CONTROL_UNWATCHED
+    elif ingest_meter.rate() > MAX_INGEST_RATE:
+        control = CONTROL_OVERLOADED
+    else:
+        control = CONTROL_WATCHED
+    
+    # Rangos de datos crudos que el gateway (en modo agregado) debe subir
+    pending = raw_requests.pending(gateway_id)
+    return {**control, 'raw_requests': pending} if pending else control
+
+
+def push_gateway_controls(only_gateway=None):
+    """Envía el control actual a cada gateway conectado por socket (o solo a uno)"""
+    for sid, gateway_id in list(data_store.gateway_sockets.items()):
+        if only_gateway is not None and gateway_id != only_gateway:
+            continue
+        socketio.emit('control', gateway_control(gateway_id), namespace=GATEWAY_NAMESPACE, to=sid)
+
+
+# ==================== DATOS CRUDOS BAJO DEMANDA ====================
+# Un gateway en modo agregado solo envía resúmenes por intervalo y guarda las
+# lecturas crudas en disco unas horas. Un rango se pide con
+# POST /api/raw_requests; la petición viaja al gateway en el control y este
+# sube las lecturas por trozos a /api/gateway/raw.
+
+class RawRequests:
+    """Peticiones de datos crudos a gateways y las lecturas recibidas"""
+    
+    def __init__(self, max_samples=100_000, ttl=3600, max_open=3):
+        self.max_samples = max_samples
+        self.ttl = ttl
+        self.max_open = max_open
+        self.requests = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def create(self, gateway_id, start, end, device_id=None):
+        """
+        Registra una petición de [start, end] (timestamps Unix) y retorna su id,
+        o None si el gateway ya tiene max_open peticiones sin terminar
+
+        Con device_id solo se piden las lecturas de ese sensor del gateway.
+        """
+        with self.lock:
+            self._prune()
+            open_requests = sum(
+                1 for req in self.requests.values()
+                if req['gateway_id'] == gateway_id and req['status'] != 'done'
+            )
+            if open_requests >= self.max_open:
+                return None
+            request_id = uuid.uuid4().hex
+            self.requests[request_id] = {
+                'gateway_id': gateway_id,
+                'device_id': device_id,
+                'start': start,
+                'end': end,
+                'status': 'pending',
+                'created': time.time(),
+                'samples': [],
+                'truncated': False,
+                'error': None
+            }
+            return request_id
+    
+    def pending(self, gateway_id):
+        """Peticiones sin terminar de un gateway, tal como viajan en el control"""
+        with self.lock:
+            return [
+                {'id': request_id, 'start': req['start'], 'end': req['end'], 'device_id': req['device_id']}
+                for request_id, req in self.requests.items()
+                if req['gateway_id'] == gateway_id and req['status'] != 'done'
+            ]
+    
+    def receive(self, gateway_id, request_id, part, samples, done, error=None):
+        """
+        Añade un trozo subido por el gateway (part 0 reinicia la subida)
+
+        Returns:
+            bool: False si la petición no existe o es de otro gateway
+        """
+        with self.lock:
+            req = self.requests.get(request_id)
+            if not req or req['gateway_id'] != gateway_id:
+                return False
+            
+            if part == 0:
+                req['samples'] = []
+                req['truncated'] = False
+            room = self.max_samples - len(req['samples'])
+            if len(samples) > room:
+                req['truncated'] = True
+            req['samples'].extend(samples[:max(0, room)])
+            req['status'] = 'done' if done else 'receiving'
+            req['error'] = error
+            return True
+    
+    def get(self, request_id):
+        with self.lock:
+            req = self.requests.get(request_id)
+            return dict(req) if req else None
+    
+    def _prune(self):
+        """Descarta peticiones más viejas que el TTL (requiere self.lock)"""
+        limit = time.time() - self.ttl
+        for request_id in [k for k, req in self.requests.items() if req['created'] < limit]:
+            del self.requests[request_id]
+
+
+raw_requests = RawRequests(
+    max_samples=int(os.getenv('RAW_REQUEST_MAX_SAMPLES', 100_000)),
+    ttl=int(os.getenv('RAW_REQUEST_TTL', 3600)),
+    max_open=int(os.getenv('RAW_REQUEST_MAX_OPEN', 3))
+)
+
+# Rango máximo (segundos) de una petición de datos crudos
+RAW_REQUEST_MAX_RANGE = float(os.getenv('RAW_REQUEST_MAX_RANGE', 3600))
+
+
+def ingest_samples(samples, gateway_id=None):
+    """
+    Aplica un lote de muestras al data store y lo difunde a los clientes web
+
+    Returns:
+        list: [primera seq, última seq] que el gateway puede borrar de su cola,
+        o None si las muestras no llevan seq
+    """
+    samples, ack = data_store.filter_seen(gateway_id, samples)
+    ingest_meter.add(len(samples))
+    
+    alerts = []
+    onset = None
+    with data_store.lock:
+        for data in samples:
+            alert = data_store.update(data, gateway_id)
+            if alert:
+                alerts.append(alert)
+                if alert.get('stress_onset'):
+                    onset = (alert, data)
+    
+    if onset and data_store.watchers:
+        prefetch_stress_tips(*onset)
+    
+    # Las alertas salen antes que los datos: así el dashboard sabe que los
+    # consejos ya vienen en camino cuando pinta el estado STRESS
+    for alert in alerts:
+        socketio.emit('nueva_alerta', alert, namespace='/')
+    
+    # Emitir a los clientes web (una vez por lote); sin observadores no se
+    # construye el snapshot con los buffers
+    if samples and data_store.watchers:
+        socketio.emit('nuevos_datos', data_store.get_current(), namespace='/')
+    
+    return ack
+
 
 # ==================== RUTAS PÚBLICAS (WEB) ====================
 
@@ -193,10 +870,7 @@ def get_status():
         data = data_store.get_current()
         
         # Verificar si hay gateways conectados
-        connected_gateways = 0
-        for gateway_id, last_seen in data_store.gateway_last_seen.items():
-            if datetime.now() - last_seen < timedelta(minutes=2):
-                connected_gateways += 1
+        connected_gateways = data_store.connected_gateways()
         
         return jsonify({
             'success': True,
@@ -225,6 +899,225 @@ def get_alerts():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/raw_requests', methods=['POST'])
+def create_raw_request():
+    """Pide a un gateway en modo agregado las lecturas crudas de un rango"""
+    # Datos biométricos crudos y carga en el enlace del gateway: solo con el secreto
+    if not verify_gateway_auth():
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    gateway_id = data.get('gateway_id')
+    
+    try:
+        start = float(data['start'])
+        end = float(data.get('end') or time.time())
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'start y end deben ser timestamps Unix'}), 400
+    
+    if not gateway_id or end <= start:
+        return jsonify({'success': False, 'error': 'gateway_id y un rango válido son requeridos'}), 400
+    if end - start > RAW_REQUEST_MAX_RANGE:
+        return jsonify({'success': False, 'error': f'El rango máximo es de {int(RAW_REQUEST_MAX_RANGE)} s'}), 400
+    if gateway_id not in data_store.gateways:
+        return jsonify({'success': False, 'error': 'Gateway no registrado'}), 404
+    
+    request_id = raw_requests.create(gateway_id, start, end, data.get('device_id'))
+    if request_id is None:
+        return jsonify({'success': False, 'error': 'Demasiadas peticiones abiertas para este gateway'}), 429
+    
+    # Por socket la petición llega al momento; por HTTP, en la próxima respuesta
+    push_gateway_controls(gateway_id)
+    
+    return jsonify({'success': True, 'request_id': request_id}), 202
+
+
+@app.route('/api/raw_requests/<request_id>', methods=['GET'])
+def raw_request_status(request_id):
+    """Estado de una petición de datos crudos y las lecturas recibidas"""
+    if not verify_gateway_auth():
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    req = raw_requests.get(request_id)
+    if not req:
+        return jsonify({'success': False, 'error': 'Petición no encontrada'}), 404
+    
+    return jsonify({
+        'success': True,
+        'request_id': request_id,
+        'gateway_id': req['gateway_id'],
+        'device_id': req['device_id'],
+        'status': req['status'],
+        'samples': req['samples'],
+        'truncated': req['truncated'],
+        'error': req['error']
+    })
+
+
+# ==================== TRABAJOS DE IA (ASÍNCRONOS) ====================
+# Las llamadas a OpenRouter pueden tardar hasta 30 s. Se ejecutan en un pool
+# acotado para no ocupar los hilos que atienden la ingesta y el dashboard:
+# el endpoint responde con un job_id y el resultado llega por Socket.IO
+# ('ai_result') o consultando /api/ai_jobs/<job_id>.
+
+class AIJobs:
+    """Pool acotado de trabajos de IA con sus resultados recientes"""
+    
+    def __init__(self, workers=2, max_pending=20, ttl=300):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-job')
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self.pending = 0
+        self.lock = threading.Lock()
+        
+        # Trabajos pendientes por clave normalizada -> (job_id, future, sids)
+        self.inflight = {}
+    
+    def submit(self, kind, func, *args, sid=None, job_id=None, key=None, broadcast=False):
+        """
+        Encola func(*args)
+
+        Si ya hay un trabajo pendiente con la misma `key`, no se encola otro:
+        el cliente se suma a ese trabajo y recibe su mismo resultado. Con
+        `broadcast` el resultado se envía a todos los clientes web.
+
+        Returns:
+            tuple: (job_id, future), o (None, None) si el pool está lleno
+        """
+        with self.lock:
+            if key is not None and key in self.inflight:
+                job_id, future, sids = self.inflight[key]
+                if sid:
+                    sids.append(sid)
+                return job_id, future
+            
+            if self.pending >= self.max_pending:
+                return None, None
+            self.pending += 1
+            job_id = job_id or uuid.uuid4().hex
+            self.jobs[job_id] = {'status': 'pending', 'kind': kind, 'created': time.time(), 'result': None}
+            self._prune()
+            
+            sids = [sid] if sid else []
+            future = self.executor.submit(self._run, job_id, kind, func, args, sids, key, broadcast)
+            if key is not None:
+                self.inflight[key] = (job_id, future, sids)
+        
+        return job_id, future
+    
+    def _run(self, job_id, kind, func, args, sids, key, broadcast=False):
+        try:
+            result = func(*args)
+        except Exception as e:
+            logger.error(f"Error en trabajo de IA {kind}: {e}", exc_info=True)
+            result = {'success': False, 'error': 'Error interno del servidor'}
+        
+        with self.lock:
+            self.pending -= 1
+            self.inflight.pop(key, None)
+            job = self.jobs.get(job_id)
+            if job:
+                job.update(status='done', result=result)
+        
+        payload = {'job_id': job_id, 'kind': kind, 'result': result}
+        if broadcast:
+            socketio.emit('ai_result', payload, namespace='/')
+        else:
+            for sid in sids:
+                socketio.emit('ai_result', payload, namespace='/', to=sid)
+        return result
+    
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def _prune(self):
+        """Descarta trabajos terminados más viejos que el TTL (requiere self.lock)"""
+        limit = time.time() - self.ttl
+        for job_id in [k for k, job in self.jobs.items() if job['status'] == 'done' and job['created'] < limit]:
+            del self.jobs[job_id]
+
+
+ai_jobs = AIJobs(
+    workers=int(os.getenv('AI_WORKERS', 2)),
+    max_pending=int(os.getenv('AI_MAX_PENDING', 20))
+)
+
+# Historial de chat por navegador (cookie de sesión de Flask)
+chat_sessions = ChatSessions(
+    max_sessions=int(os.getenv('CHAT_MAX_SESSIONS', 500)),
+    context_tokens=int(os.getenv('CHAT_CONTEXT_TOKENS', 600)),
+    summary_tokens=int(os.getenv('CHAT_SUMMARY_TOKENS', 200))
+) if ai_service else None
+
+
+def prefetch_stress_tips(alert, data):
+    """
+    Pide los consejos en cuanto empieza un episodio de estrés, sin esperar a
+    que el dashboard los solicite
+
+    Adjunta a la alerta los consejos (si se pueden responder sin IA) o el
+    job_id cuyo 'ai_result' se difundirá a todos los clientes.
+    """
+    if not ai_service:
+        return
+    
+    fc, spo2 = data.get('fc', 0), data.get('spo2', 0)
+    temp, state = data.get('temp', 0.0), data.get('state', 'STRESS')
+    
+    try:
+        ready = ai_service.cached_stress_tips(fc, spo2, temp, state)
+        if ready is not None:
+            alert['tips'] = ready
+            return
+        
+        key = ('tips',) + TipsCache.key(fc, spo2, temp, state)
+        job_id, _ = ai_jobs.submit('tips', ai_service.get_stress_tips, fc, spo2, temp, state,
+                                   key=key, broadcast=True)
+        if job_id:
+            alert['tips_job_id'] = job_id
+            logger.info(f"🔮 Consejos precargados al detectar estrés (job {job_id})")
+    except Exception as e:
+        logger.error(f"Error precargando consejos: {e}")
+
+
+def chat_session_id():
+    """ID de la sesión de chat del navegador actual (se crea si no existe)"""
+    if 'chat_id' not in session:
+        session['chat_id'] = uuid.uuid4().hex
+    return session['chat_id']
+
+
+def run_chat(chat_id, message, on_token=None):
+    """Chat con el historial de la sesión; guarda el intercambio si tuvo éxito"""
+    result = ai_service.chat(message, chat_sessions.context(chat_id), on_token)
+    if result.get('success'):
+        chat_sessions.append(chat_id, message, result['response'])
+    return result
+
+
+# Espera máxima del modo síncrono ("async": false)
+AI_SYNC_TIMEOUT = float(os.getenv('AI_SYNC_TIMEOUT', 60))
+
+
+def submit_ai_job(kind, func, *args, job_id=None, key=None):
+    """Encola un trabajo de IA y responde 202 con su job_id (o espera si async=false)"""
+    data = request.get_json(silent=True) or {}
+    job_id, future = ai_jobs.submit(kind, func, *args, sid=data.get('sid'), job_id=job_id, key=key)
+    if not job_id:
+        return jsonify({
+            'success': False,
+            'error': 'Servicio de IA ocupado. Intenta en unos segundos'
+        }), 503
+    
+    if data.get('async', True) is False:
+        return jsonify(future.result(timeout=AI_SYNC_TIMEOUT))
+    
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'pending'}), 202
+
+
 @app.route('/api/ai_tips', methods=['POST'])
 def ai_tips():
     """Genera consejos de IA basados en datos biométricos"""
@@ -244,13 +1137,16 @@ def ai_tips():
         temp = data.get('temp', 0)
         state = data.get('state', 'NORMAL')
         
-        logger.info(f"Llamando a get_stress_tips con FC={fc}, SpO2={spo2}, Temp={temp}, State={state}")
+        # Respuestas en caché (o sin IA) no necesitan pasar por el pool
+        cached = ai_service.cached_stress_tips(fc, spo2, temp, state)
+        if cached is not None:
+            return jsonify(cached)
         
-        result = ai_service.get_stress_tips(fc, spo2, temp, state)
+        logger.info(f"Encolando get_stress_tips con FC={fc}, SpO2={spo2}, Temp={temp}, State={state}")
         
-        logger.info(f"Resultado de IA: success={result.get('success')}, error={result.get('error', 'none')}")
-        
-        return jsonify(result)
+        # Varios dashboards con la misma lectura comparten un solo trabajo
+        key = ('tips',) + TipsCache.key(fc, spo2, temp, state)
+        return submit_ai_job('tips', ai_service.get_stress_tips, fc, spo2, temp, state, key=key)
         
     except Exception as e:
         logger.error(f"Error en /api/ai_tips: {e}", exc_info=True)
@@ -273,7 +1169,6 @@ def chat():
     try:
         data = request.get_json()
         message = data.get('message', '').strip()
-        context = data.get('context', [])
         
         if not message:
             return jsonify({
@@ -283,11 +1178,20 @@ def chat():
         
         logger.info(f"Chat - Mensaje recibido: {message[:50]}...")
         
-        result = ai_service.chat(message, context)
+        chat_id = chat_session_id()
         
-        logger.info(f"Chat - Respuesta: success={result.get('success')}")
+        # Streaming opcional: los fragmentos llegan como 'chat_token' al socket
+        # del cliente y la respuesta completa como 'ai_result'
+        sid = data.get('sid')
+        if data.get('stream') and sid:
+            job_id = uuid.uuid4().hex
+            
+            def emit_token(token):
+                socketio.emit('chat_token', {'job_id': job_id, 'token': token}, namespace='/', to=sid)
+            
+            return submit_ai_job('chat', run_chat, chat_id, message, emit_token, job_id=job_id)
         
-        return jsonify(result)
+        return submit_ai_job('chat', run_chat, chat_id, message)
         
     except Exception as e:
         logger.error(f"Error en /api/chat: {e}", exc_info=True)
@@ -297,15 +1201,46 @@ def chat():
         }), 500
 
 
+@app.route('/api/chat/clear', methods=['POST'])
+def chat_clear():
+    """Borra el historial de chat de esta sesión"""
+    if chat_sessions and 'chat_id' in session:
+        chat_sessions.clear(session['chat_id'])
+    return jsonify({'success': True})
+
+
+@app.route('/api/ai_jobs/<job_id>', methods=['GET'])
+def ai_job_status(job_id):
+    """Consulta de un trabajo de IA (alternativa al evento 'ai_result')"""
+    job = ai_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'kind': job['kind'],
+        'status': job['status'],
+        'result': job['result']
+    })
+
+
 @app.route('/api/ai_test', methods=['GET'])
 def ai_test():
-    """Endpoint de diagnóstico para probar la IA"""
+    """
+    Endpoint de diagnóstico de la IA
+
+    Por defecto solo informa de la salud observada en las llamadas reales
+    (no consume cuota). Con ?probe=1 hace además una prueba mínima en vivo,
+    limitada y cacheada por AIService.probe().
+    """
     diagnostics = {
         'ai_service_initialized': ai_service is not None,
         'api_key_configured': False,
         'api_key_length': 0,
         'base_url': None,
         'model': None,
+        'health': None,
         'test_result': None
     }
     
@@ -316,17 +1251,14 @@ def ai_test():
             diagnostics['api_key_prefix'] = ai_service.api_key[:10] + "..." if len(ai_service.api_key) > 10 else "too short"
         diagnostics['base_url'] = ai_service.base_url
         diagnostics['model'] = ai_service.model
+        diagnostics['models'] = ai_service.models
+        diagnostics['health'] = ai_service.health()
         
-        # Test simple
-        try:
-            test_result = ai_service.get_stress_tips(85, 98, 36.5, 'STRESS')
-            diagnostics['test_result'] = {
-                'success': test_result.get('success'),
-                'has_tips': bool(test_result.get('tips')),
-                'error': test_result.get('error', 'none')
-            }
-        except Exception as e:
-            diagnostics['test_result'] = {'error': str(e)}
+        if request.args.get('probe') in ('1', 'true'):
+            try:
+                diagnostics['test_result'] = ai_service.probe()
+            except Exception as e:
+                diagnostics['test_result'] = {'error': str(e)}
     
     return jsonify(diagnostics)
 
@@ -340,7 +1272,7 @@ def gateway_register():
         return jsonify({'success': False, 'error': 'No autorizado'}), 401
     
     try:
-        data = request.get_json()
+        data = get_gateway_json()
         gateway_id = data.get('gateway_id')
         
         if not gateway_id:
@@ -354,6 +1286,8 @@ def gateway_register():
             'timestamp': datetime.now().isoformat()
         })
         
+    except GatewayPayloadError as e:
+        return gateway_payload_error_response(e)
     except Exception as e:
         logger.error(f"Error en /api/gateway/register: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -377,40 +1311,70 @@ def gateway_ping():
 
 @app.route('/api/gateway/data', methods=['POST'])
 def gateway_data():
-    """Endpoint para recibir datos del gateway"""
+    """Endpoint para recibir datos del gateway (una lectura o un lote)"""
     if not verify_gateway_auth():
         return jsonify({'success': False, 'error': 'No autorizado'}), 401
     
     try:
-        data = request.get_json()
+        gateway_id, samples = get_gateway_samples()
+        ack = ingest_samples(samples, gateway_id)
         
-        # Actualizar data store
-        data_store.update(data)
-        
-        # Emitir a todos los clientes conectados vía WebSocket
-        socketio.emit('nuevos_datos', data_store.get_current(), namespace='/')
-        
-        # Verificar si hay alerta
-        alert = data_store._check_alerts(data)
-        if alert:
-            socketio.emit('nueva_alerta', alert, namespace='/')
-        
-        return jsonify({
+        control = gateway_control(gateway_id)
+        response = jsonify({
             'success': True,
+            'received': len(samples),
+            'ack': ack,
+            'control': control,
             'timestamp': datetime.now().isoformat()
         })
+        response.headers['X-Filsync-Control'] = json.dumps(control, separators=(',', ':'))
+        return response
         
+    except GatewayPayloadError as e:
+        return gateway_payload_error_response(e)
     except Exception as e:
         logger.error(f"Error en /api/gateway/data: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/gateway/raw', methods=['POST'])
+def gateway_raw():
+    """Lecturas crudas subidas por un gateway para una petición de rango"""
+    if not verify_gateway_auth():
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    try:
+        data = get_gateway_json()
+        samples = data.get('samples') or []
+        accepted = raw_requests.receive(
+            data.get('gateway_id'),
+            data.get('request_id'),
+            int(data.get('part', 0)),
+            samples if isinstance(samples, list) else [],
+            bool(data.get('done')),
+            data.get('error')
+        )
+        if not accepted:
+            return jsonify({'success': False, 'error': 'Petición no encontrada'}), 404
+        
+        return jsonify({'success': True, 'received': len(samples)})
+        
+    except GatewayPayloadError as e:
+        return gateway_payload_error_response(e)
+    except Exception as e:
+        logger.error(f"Error en /api/gateway/raw: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 # ==================== WEBSOCKET HANDLERS ====================
 
 @socketio.on('connect')
 def handle_connect():
     """Cliente conectado vía WebSocket"""
     logger.info(f"Cliente web conectado: {request.sid}")
+    # Por defecto el dashboard observa todos los gateways
+    data_store.add_watcher(request.sid)
+    push_gateway_controls()
     # Enviar datos actuales al nuevo cliente
     emit('nuevos_datos', data_store.get_current())
 
@@ -419,6 +1383,16 @@ def handle_connect():
 def handle_disconnect():
     """Cliente desconectado"""
     logger.info(f"Cliente web desconectado: {request.sid}")
+    data_store.remove_watcher(request.sid)
+    push_gateway_controls()
+
+
+@socketio.on('subscribe_gateway')
+def handle_subscribe_gateway(data=None):
+    """Cliente que solo observa un gateway ({'gateway_id': ...}; vacío = todos)"""
+    gateway_id = data.get('gateway_id') if isinstance(data, dict) else None
+    data_store.add_watcher(request.sid, gateway_id or None)
+    push_gateway_controls()
 
 
 @socketio.on('request_data')
@@ -427,6 +1401,64 @@ def handle_request_data():
     emit('nuevos_datos', data_store.get_current())
 
 
+# ==================== WEBSOCKET DE GATEWAYS (AUTENTICADO) ====================
+# Canal persistente alternativo a HTTP: una sola conexión lleva muestras y
+# acks, y el heartbeat de Socket.IO sustituye a /api/gateway/ping.
+
+
+@socketio.on('connect', namespace=GATEWAY_NAMESPACE)
+def handle_gateway_connect(auth=None):
+    """Gateway conectado; se autentica con {'secret', 'gateway_id', ...} en auth"""
+    auth = auth if isinstance(auth, dict) else {}
+    secret = auth.get('secret') or request.headers.get('X-Gateway-Secret')
+    gateway_id = auth.get('gateway_id')
+    
+    if secret != GATEWAY_SECRET:
+        logger.warning(f"Socket de gateway no autorizado desde {request.remote_addr}")
+        return False
+    if not gateway_id:
+        return False
+    
+    info = {key: value for key, value in auth.items() if key != 'secret'}
+    data_store.register_gateway(gateway_id, info)
+    data_store.attach_gateway_socket(request.sid, gateway_id)
+    emit('control', gateway_control(gateway_id))
+
+
+@socketio.on('disconnect', namespace=GATEWAY_NAMESPACE)
+def handle_gateway_disconnect():
+    """Gateway desconectado"""
+    gateway_id = data_store.detach_gateway_socket(request.sid)
+    logger.info(f"Gateway desconectado del socket: {gateway_id}")
+
+
+@socketio.on('samples', namespace=GATEWAY_NAMESPACE)
+def handle_gateway_samples(payload):
+    """Muestras de un gateway: dict, lista de dicts o bytes en formato binario"""
+    gateway_id = data_store.gateway_sockets.get(request.sid)
+    if not gateway_id:
+        return {'success': False, 'error': 'No autorizado'}
+    
+    try:
+        if isinstance(payload, (bytes, bytearray)):
+            _, samples = wire_format.decode_samples(payload)
+        else:
+            samples = payload if isinstance(payload, list) else [payload]
+        
+        ack = ingest_samples(samples, gateway_id)
+        
+        return {'success': True, 'received': len(samples), 'ack': ack, 'control': gateway_control(gateway_id)}
+        
+    except wire_format.UnsupportedVersionError as e:
+        # Igual que el 415 de HTTP: el gateway vuelve a JSON
+        return {'success': False, 'error': str(e), 'status': 415}
+    except wire_format.WireFormatError as e:
+        return {'success': False, 'error': str(e)}
+    except Exception as e:
+        logger.error(f"Error en samples de gateway: {e}")
+        return {'success': False, 'error': str(e)}
+
+
 # ==================== HEALTH CHECK ====================
 
 @app.route('/health', methods=['GET'])
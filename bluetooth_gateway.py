@@ -6,6 +6,9 @@ Este script se ejecuta en tu computadora local y:
 2. Envía los datos al servidor cloud en tiempo real
 3. Es muy ligero (solo maneja la conexión BT)
 
+Todo corre en un único event loop de asyncio: lectura Bluetooth, lotes,
+envío, heartbeat y estado son tareas del mismo loop.
+
 Uso:
     python bluetooth_gateway.py
 """
@@ -16,8 +19,12 @@ import sys
 import time
 import os
 import json
-import requests
+import gzip
+import random
 import threading
+import functools
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -29,8 +36,28 @@ except ImportError:
     print("   Asegúrate de ejecutar este script en el mismo directorio que bluetooth_handler.py")
     sys.exit(1)
 
+import wire_format
+from outbox import Outbox
+
+try:
+    import zstandard
+
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+try:
+    import socketio
+
+    SOCKETIO_AVAILABLE = True
+except ImportError:
+    SOCKETIO_AVAILABLE = False
+
 load_dotenv()
 
+# Namespace Socket.IO de gateways en el servidor cloud
+GATEWAY_NAMESPACE = '/gateway'
+
 # Configurar encoding para Windows
 if sys.platform == 'win32':
     # Configurar UTF-8 para la consola de Windows
@@ -49,6 +76,141 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def crosses_alert(data):
+    """Si la lectura cruza un umbral de alerta del cloud (SpO2 < 90 % o FC > 120 bpm)"""
+    spo2 = data.get('spo2', 0)
+    return 0 < spo2 < 90 or data.get('fc', 0) > 120
+
+
+class DeadbandFilter:
+    """
+    Filtro de banda muerta por métrica
+
+    Una lectura se envía solo si el estado cambia, si entra o sale de un umbral
+    de alerta del cloud, si alguna métrica se aleja del último valor enviado más que su umbral o si pasa max_interval desde el
+    último envío. Las lecturas omitidas se cuentan y la siguiente enviada lleva
+    'held' (cuántas) y 'held_until' (timestamp de la última omitida), para que
+    el cloud reconstruya la serie escalonada.
+    """
+
+    def __init__(self, thresholds, max_interval):
+        self.thresholds = thresholds
+        self.max_interval = max_interval
+        self.suppressed = 0
+        self._last_sent = None
+        self._last_sent_at = 0.0
+        self._held = 0
+        self._held_until = None
+
+    def _changed(self, data):
+        last = self._last_sent
+        if last is None or data.get('state') != last.get('state'):
+            return True
+        # Un cruce de umbral de alerta no espera a max_interval
+        if crosses_alert(data) != crosses_alert(last):
+            return True
+        for metric, threshold in self.thresholds.items():
+            if abs(float(data.get(metric, 0)) - float(last.get(metric, 0))) > threshold:
+                return True
+        return False
+
+    def filter(self, data):
+        """Retorna la lectura a enviar (con 'held' si procede) o None si se omite"""
+        now = time.monotonic()
+        if not self._changed(data) and now - self._last_sent_at < self.max_interval:
+            self._held += 1
+            self._held_until = data.get('timestamp')
+            self.suppressed += 1
+            return None
+        
+        if self._held:
+            data['held'] = self._held
+            data['held_until'] = self._held_until
+        self._held = 0
+        self._held_until = None
+        self._last_sent = data
+        self._last_sent_at = now
+        return data
+
+
+class Aggregator:
+    """
+    Resúmenes por intervalo de las lecturas
+
+    Cada resumen lleva min/max/media/último de fc, spo2 y temp en 'stats', el
+    histograma de estados en 'states' y, en el nivel superior, los campos de
+    la última lectura (así el cloud lo trata como una lectura más).
+    """
+
+    METRICS = ('fc', 'spo2', 'temp')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self._start = None
+        self._end = None
+        self._count = 0
+        self._stats = {}
+        self._states = {}
+        self._last = None
+
+    def deadline(self):
+        """Instante (Unix) en que se cierra el intervalo abierto, o None"""
+        return self._start + self.interval if self._start is not None else None
+
+    def add(self, data):
+        """Suma una lectura; retorna el resumen del intervalo anterior si se cerró"""
+        timestamp = data.get('timestamp') or time.time()
+        summary = None
+        if self._start is not None and timestamp >= self._start + self.interval:
+            summary = self.flush()
+        
+        if self._start is None:
+            self._start = timestamp
+        self._end = timestamp
+        self._count += 1
+        self._last = data
+        for metric in self.METRICS:
+            value = float(data.get(metric, 0))
+            stats = self._stats.get(metric)
+            if stats is None:
+                self._stats[metric] = [value, value, value]
+            else:
+                stats[0] = min(stats[0], value)
+                stats[1] = max(stats[1], value)
+                stats[2] += value
+        state = data.get('state', 'SIN_DEDO')
+        self._states[state] = self._states.get(state, 0) + 1
+        return summary
+
+    def flush(self):
+        """Cierra el intervalo abierto y retorna su resumen (o None si está vacío)"""
+        if not self._count:
+            return None
+        
+        summary = {
+            **self._last,
+            'summary': True,
+            'start': self._start,
+            'end': self._end,
+            'count': self._count,
+            'stats': {
+                metric: {
+                    'min': low,
+                    'max': high,
+                    'mean': round(total / self._count, 2),
+                    'last': self._last.get(metric, 0)
+                }
+                for metric, (low, high, total) in self._stats.items()
+            },
+            'states': self._states
+        }
+        self._reset()
+        return summary
+
+
 class CloudGateway:
     """Gateway que conecta Bluetooth local con servidor cloud"""
     
@@ -57,156 +219,810 @@ class CloudGateway:
         self.secret_key = os.getenv('GATEWAY_SECRET_KEY', 'default-secret-change-me')
         self.gateway_id = os.getenv('GATEWAY_ID', 'gateway-001')
         
-        # Estado
-        self.connected_to_cloud = False
+        # Estado. Los eventos de conexión se crean en run(), dentro del loop
+        self._connected = False
+        self._connected_event = None
+        self._disconnected_event = None
         self.last_ping = 0
         self.reconnect_attempts = 0
         
-        # Bluetooth
-        self.bluetooth_handler = None
+        # Vaciados fallidos seguidos con la conexión viva (5xx, timeouts,
+        # rechazos): el siguiente espera hasta _retry_at con el mismo backoff
+        self.send_failures = 0
+        self._retry_at = 0.0
+        
+        # Reconexión tras una caída: backoff exponencial con jitter completo
+        # (primer reintento casi inmediato; con muchos gateways los reintentos
+        # se reparten en el tiempo en vez de llegar todos a la vez)
+        self.reconnect_base = float(os.getenv('GATEWAY_RECONNECT_BASE', 0.5))
+        self.reconnect_max = float(os.getenv('GATEWAY_RECONNECT_MAX', 60))
+        
+        # Bluetooth: uno o varios sensores, cada uno con su manejador y su
+        # flujo etiquetado con device_id (ver GATEWAY_DEVICES)
+        self.devices = self._parse_devices(os.getenv('GATEWAY_DEVICES', ''))
+        self.bluetooth_handlers = []
         
-        # Cola de datos
-        self.data_queue = []
-        self.queue_lock = threading.Lock()
+        # Entrega de la lectura Bluetooth a la tarea de envío: acotada y sin
+        # esperas. Si se llena se descarta la lectura más vieja (la lectura
+        # nunca espera al disco ni a la red). Se crea en run(), dentro del loop
+        self.handoff_size = int(os.getenv('GATEWAY_HANDOFF_SIZE', 1000))
+        self.handoff = None
+        self.handoff_dropped = 0
+        self._loop = None
+        self._loop_thread = None
         
-    def on_bluetooth_data(self, data):
-        """Callback cuando llegan datos del Bluetooth"""
+        # Cola de datos en disco: sobrevive a reinicios y cortes largos del cloud
+        self.outbox = Outbox(
+            path=os.getenv('GATEWAY_OUTBOX_PATH', 'gateway_outbox.db'),
+            max_entries=int(os.getenv('GATEWAY_OUTBOX_MAX_ENTRIES', 1_000_000)),
+            retention=float(os.getenv('GATEWAY_OUTBOX_RETENTION_DAYS', 7)) * 86400
+        )
+        self._flushing = False
+        # Última seq del lote en vuelo (no se puede fusionar con ella)
+        self._inflight_seq = 0
+        
+        # Modo agregado: al cloud solo van resúmenes por intervalo (uno por
+        # sensor); las lecturas crudas se guardan en disco durante la retención
+        # y se suben cuando el cloud pide un rango
+        self.aggregate_interval = None
+        self.aggregators = {}
+        self.raw_store = None
+        if os.getenv('GATEWAY_MODE', 'raw').lower() == 'aggregate':
+            self.aggregate_interval = float(os.getenv('GATEWAY_AGGREGATE_INTERVAL', 1))
+            self.raw_store = Outbox(
+                path=os.getenv('GATEWAY_RAW_PATH', 'gateway_raw.db'),
+                max_entries=int(os.getenv('GATEWAY_RAW_MAX_ENTRIES', 2_000_000)),
+                retention=float(os.getenv('GATEWAY_RAW_RETENTION_HOURS', 24)) * 3600
+            )
+        self.raw_chunk = int(os.getenv('GATEWAY_RAW_CHUNK', 1000))
+        self._raw_uploads = set()
+        
+        # Envío por lotes: sale un lote al juntar batch_size lecturas o al pasar
+        # la ventana de tiempo, con hasta max_inflight lotes en vuelo a la vez
+        self.batch_size = int(os.getenv('GATEWAY_BATCH_SIZE', 50))
+        self.batch_window = int(os.getenv('GATEWAY_BATCH_WINDOW_MS', 250)) / 1000
+        self.max_inflight = max(1, int(os.getenv('GATEWAY_MAX_INFLIGHT', 4)))
+        
+        # Sesión HTTP keep-alive (aiohttp); se abre en run()
+        self.http = None
+        
+        # Compresión del cuerpo (gzip, o zstd si está instalado)
+        self.compress_min_bytes = int(os.getenv('GATEWAY_COMPRESS_MIN_BYTES', 1024))
+        self.compression = os.getenv('GATEWAY_COMPRESSION', 'zstd' if ZSTD_AVAILABLE else 'gzip').lower()
+        if self.compression == 'zstd' and not ZSTD_AVAILABLE:
+            logger.warning("zstandard no está instalado, usando gzip")
+            self.compression = 'gzip'
+        self._zstd = zstandard.ZstdCompressor(level=3) if self.compression == 'zstd' else None
+        
+        # Formato de las muestras: 'json' o 'binary' (ver wire_format.py)
+        self.wire_format = os.getenv('GATEWAY_WIRE_FORMAT', 'json').lower()
+        
+        # Transporte: 'socketio' (conexión persistente) o 'http'
+        self.transport = os.getenv('GATEWAY_TRANSPORT', 'socketio' if SOCKETIO_AVAILABLE else 'http').lower()
+        if self.transport == 'socketio' and not SOCKETIO_AVAILABLE:
+            logger.warning("python-socketio no está instalado, usando HTTP")
+            self.transport = 'http'
+        self.sio = None
+        
+        # Control enviado por el cloud: ritmo de envío y datos crudos o
+        # resumidos. Hasta recibirlo se envía cada lectura al momento.
+        self.send_mode = 'raw'
+        self.send_interval = 0.0
+        self._next_send_at = 0.0
+        
+        # Banda muerta: solo se envían cambios significativos (umbral por
+        # métrica), las transiciones de estado y una lectura cada max_interval.
+        # Un filtro por sensor. En modo agregado no aplica: los resúmenes
+        # necesitan todas las lecturas
+        self.deadband_thresholds = None
+        self.deadband_max_interval = float(os.getenv('GATEWAY_DEADBAND_MAX_INTERVAL', 5))
+        self.deadbands = {}
+        if os.getenv('GATEWAY_DEADBAND', 'true').lower() == 'true' and not self.aggregate_interval:
+            self.deadband_thresholds = {
+                'fc': float(os.getenv('GATEWAY_DEADBAND_FC', 2)),
+                'spo2': float(os.getenv('GATEWAY_DEADBAND_SPO2', 1)),
+                'temp': float(os.getenv('GATEWAY_DEADBAND_TEMP', 0.1))
+            }
+        
+        # Última entrada de la outbox por sensor, para fusionar en modo resumen
+        self._last_entries = {}
+    
+    @property
+    def connected_to_cloud(self):
+        return self._connected
+    
+    @connected_to_cloud.setter
+    def connected_to_cloud(self, value):
+        """Cualquier cambio de conexión despierta o detiene la tarea de reconexión"""
+        self._connected = value
+        if value:
+            self.reconnect_attempts = 0
+        if self._connected_event is not None:
+            if value:
+                self._disconnected_event.clear()
+                self._connected_event.set()
+            else:
+                self._connected_event.clear()
+                self._disconnected_event.set()
+    
+    @staticmethod
+    def _parse_devices(spec):
+        """
+        Sensores de GATEWAY_DEVICES: 'id=spp:PUERTO' o 'id=ble:NOMBRE_O_MAC'
+        separados por comas (p. ej. 'cama1=spp:COM5,cama2=ble:Filsync-ESP32-2').
+
+        Returns:
+            list: Dicts con device_id, bt_type, port y device_name. Sin
+            configurar, un único sensor sin etiqueta según BLUETOOTH_TYPE
+        """
+        devices = []
+        for entry in filter(None, (part.strip() for part in spec.split(','))):
+            device_id, _, target = entry.partition('=')
+            bt_type, _, address = target.partition(':')
+            bt_type = bt_type.strip().upper()
+            if not device_id.strip() or bt_type not in ('SPP', 'BLE') or not address.strip():
+                logger.error(f"Sensor mal configurado en GATEWAY_DEVICES: '{entry}'")
+                continue
+            devices.append({
+                'device_id': device_id.strip(),
+                'bt_type': bt_type,
+                'port': address.strip() if bt_type == 'SPP' else None,
+                'device_name': address.strip() if bt_type == 'BLE' else None
+            })
+        return devices or [{'device_id': None, 'bt_type': None, 'port': None, 'device_name': None}]
+    
+    def on_bluetooth_data(self, data, device_id=None):
+        """
+        Callback cuando llegan datos del Bluetooth
+
+        Solo marca la lectura y la deja en la cola de entrega, sin tocar el
+        disco ni la red. Normalmente corre en el loop; si llega desde otro
+        hilo se pasa al loop de forma segura.
+        """
         try:
             # Log compacto solo cuando hay cambios significativos
             logger.debug(f"📡 BT: FC={data.get('fc', 0)}, SpO2={data.get('spo2', 0)}, State={data.get('state', 'N/A')}")
             
-            # Agregar timestamp y gateway_id
+            # Los buffers de gráficas se quedan en el gateway (el cloud tiene los suyos)
+            data.pop('buffers', None)
+            
+            # Agregar timestamp, gateway_id y sensor de origen
             data['gateway_id'] = self.gateway_id
             data['received_at'] = datetime.now().isoformat()
+            if device_id is not None:
+                data['device_id'] = device_id
             
-            # Enviar inmediatamente si está conectado (sin cola para reducir delay)
-            if self.connected_to_cloud:
-                self._send_data_to_cloud(data)
+            if threading.get_ident() == self._loop_thread:
+                self._offer(data)
             else:
-                # Solo encolar si no hay conexión
-                with self.queue_lock:
-                    self.data_queue.append(data)
-                logger.warning("Cloud desconectado, datos en cola")
-                
+                self._loop.call_soon_threadsafe(self._offer, data)
+        
         except Exception as e:
             logger.error(f"Error procesando datos Bluetooth: {e}")
     
-    def _send_data_to_cloud(self, data):
-        """Envía datos al servidor cloud"""
-        try:
-            headers = {
-                'Content-Type': 'application/json',
-                'X-Gateway-Secret': self.secret_key
-            }
+    def _offer(self, data):
+        """Encola una lectura en la entrega, descartando la más vieja si está llena"""
+        if self.deadband_thresholds and self._deadband(data.get('device_id')).filter(data) is None:
+            return
+        if self.handoff.full():
+            self.handoff.get_nowait()
+            self.handoff_dropped += 1
+            if self.handoff_dropped % 100 == 1:
+                logger.warning(f"Cola de entrega llena: {self.handoff_dropped} lecturas descartadas")
+        self.handoff.put_nowait(data)
+    
+    def _deadband(self, device_id):
+        """Filtro de banda muerta del sensor (se crea con su primera lectura)"""
+        deadband = self.deadbands.get(device_id)
+        if deadband is None:
+            deadband = self.deadbands[device_id] = DeadbandFilter(self.deadband_thresholds, self.deadband_max_interval)
+        return deadband
+    
+    def _aggregator(self, device_id):
+        """Agregador del sensor (se crea con su primera lectura)"""
+        aggregator = self.aggregators.get(device_id)
+        if aggregator is None:
+            aggregator = self.aggregators[device_id] = Aggregator(self.aggregate_interval)
+        return aggregator
+    
+    async def _sender(self):
+        """Tarea de envío: pasa las lecturas a la outbox y vacía la cola hacia el cloud"""
+        while True:
+            # Despertar a tiempo para cerrar la ventana del lote pendiente; sin
+            # conexión no hay ventana: se espera una lectura o la reconexión
+            connected = self.connected_to_cloud
+            timeout = 1.0
+            if connected and len(self.outbox):
+                send_at = max(self._next_send_at, self._retry_at)
+                timeout = min(timeout, max(0.01, send_at - time.time()))
+            deadlines = [a.deadline() for a in self.aggregators.values() if a.deadline()]
+            if deadlines:
+                timeout = min(timeout, max(0.01, min(deadlines) - time.time()))
+            
+            getter = asyncio.ensure_future(self.handoff.get())
+            waiters = {getter}
+            if not connected and self._connected_event is not None:
+                waiters.add(asyncio.ensure_future(self._connected_event.wait()))
+            try:
+                await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+            data = getter.result() if getter.done() and not getter.cancelled() else None
             
-            response = requests.post(
-                f"{self.cloud_url}/api/gateway/data",
-                json=data,
-                headers=headers,
-                timeout=3  # Reducido de 5 a 3 segundos
+            try:
+                # Pasar a disco todo lo que esperaba antes de enviar
+                while data is not None:
+                    self._accept(data)
+                    data = self.handoff.get_nowait() if not self.handoff.empty() else None
+                
+                # Cerrar los intervalos vencidos aunque el sensor haya dejado de enviar
+                now = time.time()
+                for aggregator in self.aggregators.values():
+                    if aggregator.deadline() and now >= aggregator.deadline():
+                        self._enqueue(aggregator.flush())
+                
+                if self.connected_to_cloud:
+                    await self._maybe_flush()
+            except Exception as e:
+                logger.error(f"Error en la tarea de envío: {e}")
+    
+    def _accept(self, data):
+        """Pasa una lectura a la outbox o, en modo agregado, al disco y al resumen"""
+        if not self.aggregate_interval:
+            self._enqueue(data)
+            return
+        
+        self.raw_store.append(data)
+        summary = self._aggregator(data.get('device_id')).add(data)
+        if summary:
+            self._enqueue(summary)
+    
+    def _enqueue(self, data):
+        """Guarda una lectura en la outbox (o la fusiona en modo resumen)"""
+        # Los resúmenes del modo agregado no se fusionan: cada uno cubre su intervalo
+        coalesce = self.send_mode == 'summary' and self.connected_to_cloud and not self.aggregate_interval
+        device_id = data.get('device_id')
+        last = self._last_entries.get(device_id) if coalesce else None
+        if (last and last[0] > self._inflight_seq and last[1].get('state') == data.get('state')
+                and not crosses_alert(last[1]) and not crosses_alert(data)):
+            # El cloud solo quiere la última lectura de cada intervalo (por
+            # sensor); los cambios de estado y las lecturas que disparan una
+            # alerta se conservan siempre. Si la entrada ya se envió, la
+            # lectura va en una nueva
+            data['coalesced'] = last[1].get('coalesced', 1) + 1
+            if self.outbox.replace(last[0], data):
+                self._last_entries[device_id] = (last[0], data)
+                data = None
+            else:
+                data.pop('coalesced')
+        if data is not None:
+            self._last_entries[device_id] = (self.outbox.append(data), data)
+        
+        if not self.connected_to_cloud:
+            logger.warning("Cloud desconectado, datos en cola")
+    
+    def _encode_body(self, payload, binary=False):
+        """
+        Serializa el payload y lo comprime si supera el umbral
+
+        Returns:
+            tuple: (cuerpo, Content-Type, Content-Encoding o None)
+        """
+        if binary:
+            samples = payload if isinstance(payload, list) else [payload]
+            body = wire_format.encode_samples(samples, self.gateway_id)
+            content_type = wire_format.CONTENT_TYPE
+        else:
+            body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+            content_type = 'application/json'
+        
+        if self.compression == 'none' or len(body) < self.compress_min_bytes:
+            return body, content_type, None
+        if self.compression == 'zstd':
+            return self._zstd.compress(body), content_type, 'zstd'
+        return gzip.compress(body, compresslevel=6), content_type, 'gzip'
+    
+    async def _post_to_cloud(self, path, payload, timeout, binary=False):
+        """
+        POST autenticado al cloud, con el cuerpo comprimido cuando conviene
+
+        Returns:
+            aiohttp.ClientResponse: Respuesta con el cuerpo ya leído
+        """
+        body, content_type, encoding = self._encode_body(payload, binary)
+        headers = {
+            'Content-Type': content_type,
+            'X-Gateway-Secret': self.secret_key
+        }
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        
+        async with self.http.post(
+            f"{self.cloud_url}{path}",
+            data=body,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            await response.read()
+        
+        if response.status == 415:
+            # Servidor sin soporte zstd: bajar a gzip y reintentar una vez
+            if encoding == 'zstd' and 'zstd' not in response.headers.get('Accept-Encoding', ''):
+                logger.warning("El servidor no acepta zstd, usando gzip")
+                self.compression = 'gzip'
+                return await self._post_to_cloud(path, payload, timeout, binary)
+            # Servidor sin formato binario (o de otra versión): volver a JSON
+            if binary:
+                logger.warning("El servidor no acepta el formato binario, usando JSON")
+                self.wire_format = 'json'
+                return await self._post_to_cloud(path, payload, timeout)
+        return response
+    
+    @staticmethod
+    def _ack_range(response):
+        """[primera, última] seq confirmadas por el cloud, o None (servidor sin acks por seq)"""
+        ack = response.get('ack') if isinstance(response, dict) else None
+        if isinstance(ack, list) and len(ack) == 2:
+            return ack
+        return None
+    
+    def _mark_sent(self):
+        """Marca un envío exitoso (la cola la vacía _flush_queue)"""
+        self.connected_to_cloud = True
+        logger.debug("✓ Enviado")
+    
+    async def _send_data_to_cloud(self, data):
+        """
+        Envía datos al servidor cloud (una lectura o una lista de lecturas)
+
+        Returns:
+            [primera, última] seq confirmadas, True si el cloud aceptó sin
+            indicar seq, o False si falló
+        """
+        if self.transport == 'socketio':
+            return await self._send_via_socket(data)
+        
+        try:
+            response = await self._post_to_cloud(
+                "/api/gateway/data",
+                data,
+                timeout=3,  # Reducido de 5 a 3 segundos
+                binary=self._binary()
             )
             
-            if response.status_code == 200:
-                # Remover de cola si se envió exitosamente
-                with self.queue_lock:
-                    if data in self.data_queue:
-                        self.data_queue.remove(data)
-                        
-                self.connected_to_cloud = True
-                self.reconnect_attempts = 0
-                logger.debug("✓ Enviado")
-                return True
+            if response.status == 200:
+                self._mark_sent()
+                control = response.headers.get('X-Filsync-Control')
+                if control:
+                    self._apply_control(json.loads(control))
+                return self._ack_range(await response.json()) or True
             else:
-                logger.warning(f"Cloud código: {response.status_code}")
+                logger.warning(f"Cloud código: {response.status}")
                 return False
-                
-        except requests.exceptions.ConnectionError:
+        
+        except aiohttp.ClientConnectionError:
             if self.connected_to_cloud:
                 logger.error("❌ Conexión perdida con el servidor cloud")
             self.connected_to_cloud = False
             return False
-            
+        
         except Exception as e:
-            logger.error(f"Error enviando datos al cloud: {e}")
+            logger.error(f"Error enviando datos al cloud: {e!r}")
             return False
     
-    def _flush_queue(self):
-        """Intenta enviar datos pendientes en la cola"""
-        if not self.connected_to_cloud:
+    async def _send_via_socket(self, data):
+        """Envía datos por el canal Socket.IO y espera el ack del servidor"""
+        # El namespace cuenta como conectado antes que sio.connected (el
+        # handler de 'connect' ya vacía la cola mientras connect() termina)
+        if not self.sio or GATEWAY_NAMESPACE not in self.sio.namespaces:
+            self.connected_to_cloud = False
+            return False
+        
+        payload = data
+        if self._binary():
+            payload = wire_format.encode_samples(data if isinstance(data, list) else [data], self.gateway_id)
+        
+        try:
+            ack = await self.sio.call('samples', payload, namespace=GATEWAY_NAMESPACE, timeout=3)
+        except socketio.exceptions.TimeoutError:
+            logger.warning("Sin ack del servidor cloud")
+            return False
+        except socketio.exceptions.SocketIOError as e:
+            logger.error(f"Error enviando por socket: {e}")
+            return False
+        
+        if isinstance(ack, dict) and ack.get('success'):
+            self._mark_sent()
+            self._apply_control(ack.get('control'))
+            return self._ack_range(ack) or True
+        
+        # Servidor sin esta versión del formato binario (los anteriores solo
+        # indican el error): volver a JSON y reenviar, como con el 415 de HTTP
+        if isinstance(payload, bytes) and isinstance(ack, dict) and (
+                ack.get('status') == 415 or str(ack.get('error', '')).startswith('Versión de formato no soportada')):
+            logger.warning("El servidor no acepta el formato binario, usando JSON")
+            self.wire_format = 'json'
+            return await self._send_via_socket(data)
+        
+        logger.warning(f"Cloud rechazó datos: {ack}")
+        return False
+    
+    def _binary(self):
+        """Si los lotes van en formato binario (los resúmenes solo caben en JSON)"""
+        return self.wire_format == 'binary' and not self.aggregate_interval
+    
+    def _apply_control(self, control):
+        """Aplica el control enviado por el cloud (ritmo, lote, modo y peticiones de datos crudos)"""
+        if not isinstance(control, dict):
+            return
+        
+        for raw_request in control.get('raw_requests') or []:
+            if isinstance(raw_request, dict) and raw_request.get('id') not in self._raw_uploads:
+                self._raw_uploads.add(raw_request.get('id'))
+                asyncio.create_task(self._upload_raw(raw_request))
+        
+        mode = control.get('mode', self.send_mode)
+        interval = max(0, int(control.get('send_interval_ms', self.send_interval * 1000))) / 1000
+        batch_size = max(1, int(control.get('batch_size', self.batch_size)))
+        if (mode, interval, batch_size) == (self.send_mode, self.send_interval, self.batch_size):
             return
-            
-        with self.queue_lock:
-            queue_copy = self.data_queue.copy()
         
-        for data in queue_copy:
-            if self._send_data_to_cloud(data):
-                logger.info(f"✓ Dato pendiente enviado al cloud")
+        self.send_mode = mode if mode in ('raw', 'summary') else 'raw'
+        self.send_interval = interval
+        self.batch_size = batch_size
+        self._next_send_at = min(self._next_send_at, time.time() + interval)
+        logger.info(f"🎛️  Control del cloud: modo={self.send_mode}, intervalo={int(interval * 1000)} ms, lote={batch_size}")
     
-    def _register_gateway(self):
-        """Registra este gateway en el servidor cloud"""
+    async def _upload_raw(self, raw_request):
+        """Sube por trozos las lecturas crudas del rango que pidió el cloud"""
+        request_id = raw_request.get('id')
+        payload = {'gateway_id': self.gateway_id, 'request_id': request_id}
+        uploaded = False
         try:
-            headers = {
-                'Content-Type': 'application/json',
-                'X-Gateway-Secret': self.secret_key
-            }
+            if not self.raw_store:
+                await self._post_to_cloud("/api/gateway/raw", {
+                    **payload, 'part': 0, 'samples': [], 'done': True,
+                    'error': 'El gateway no está en modo agregado'
+                }, timeout=10)
+                uploaded = True
+                return
             
-            payload = {
-                'gateway_id': self.gateway_id,
-                'bluetooth_type': os.getenv('BLUETOOTH_TYPE', 'SPP'),
-                'device_name': os.getenv('BLE_DEVICE_NAME', 'Filsync-ESP32'),
-                'registered_at': datetime.now().isoformat()
-            }
+            start = float(raw_request.get('start', 0))
+            end = float(raw_request.get('end') or time.time())
+            logger.info(f"📤 Subiendo datos crudos pedidos por el cloud ({datetime.fromtimestamp(start):%H:%M:%S} - {datetime.fromtimestamp(end):%H:%M:%S})")
             
-            response = requests.post(
-                f"{self.cloud_url}/api/gateway/register",
-                json=payload,
-                headers=headers,
-                timeout=10
-            )
+            # Sin device_id se suben las lecturas de todos los sensores
+            device_id = raw_request.get('device_id')
+            after = 0
+            part = 0
+            sent = 0
+            while True:
+                entries = self.raw_store.between(start, end, self.raw_chunk, after)
+                done = len(entries) < self.raw_chunk
+                samples = [data for _, data in entries if device_id is None or data.get('device_id') == device_id]
+                response = await self._post_to_cloud("/api/gateway/raw", {
+                    **payload, 'part': part, 'samples': samples, 'done': done
+                }, timeout=30)
+                if response.status != 200:
+                    logger.warning(f"Subida de datos crudos rechazada: {response.status}")
+                    return
+                sent += len(samples)
+                if done:
+                    break
+                after = entries[-1][0]
+                part += 1
             
-            if response.status_code == 200:
+            uploaded = True
+            logger.info(f"✓ {sent} lecturas crudas subidas al cloud")
+        except Exception as e:
+            logger.error(f"Error subiendo datos crudos: {e!r}")
+        finally:
+            # Si falló, el cloud la vuelve a pedir en el siguiente control
+            if not uploaded:
+                self._raw_uploads.discard(request_id)
+    
+    async def _maybe_flush(self):
+        """Vacía la cola si venció la ventana de envío o se llenó un lote"""
+        pending = len(self.outbox)
+        if not pending or time.time() < self._retry_at:
+            return
+        if time.time() >= self._next_send_at or pending >= self.batch_size:
+            self._next_send_at = time.time() + max(self.send_interval, self.batch_window)
+            await self._flush_queue()
+    
+    async def _flush_queue(self):
+        """
+        Envía los datos pendientes en lotes de batch_size, con hasta
+        max_inflight lotes en vuelo a la vez
+
+        Cada lote se confirma (y se borra de la outbox) por separado. Si uno
+        falla se deja de enviar: lo no confirmado sigue en disco y se reenvía
+        en el siguiente vaciado.
+        """
+        if not self.connected_to_cloud:
+            return
+        
+        # Un solo vaciado a la vez (tarea de envío, socket y heartbeat)
+        if self._flushing:
+            return
+        self._flushing = True
+        
+        inflight = {}
+        last_seq = 0
+        failed = False
+        sent = False
+        try:
+            while True:
+                while not failed and len(inflight) < self.max_inflight:
+                    entries = self.outbox.peek(self.batch_size, after=last_seq)
+                    if not entries:
+                        break
+                    last_seq = self._inflight_seq = entries[-1][0]
+                    # Cada lectura viaja con su seq (y la época del outbox): el
+                    # cloud confirma por rango y descarta las repetidas si un
+                    # ack se pierde
+                    batch = [{**data, 'seq': seq, 'epoch': self.outbox.epoch} for seq, data in entries]
+                    task = asyncio.create_task(self._send_data_to_cloud(batch))
+                    inflight[task] = entries
+                
+                if not inflight:
+                    return
+                
+                done, _ = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    entries = inflight.pop(task)
+                    result = task.result() if task.exception() is None else False
+                    if isinstance(result, list):
+                        # Solo se borra del disco lo que el cloud confirmó (un
+                        # borrado por rango, acotado al lote enviado)
+                        self.outbox.ack_range(max(result[0], entries[0][0]), min(result[1], entries[-1][0]))
+                        logger.debug(f"✓ {len(entries)} datos enviados al cloud")
+                        sent = True
+                    elif result:
+                        self.outbox.ack([seq for seq, _ in entries])
+                        logger.debug(f"✓ {len(entries)} datos enviados al cloud")
+                        sent = True
+                    else:
+                        failed = True
+        finally:
+            self._inflight_seq = 0
+            self._flushing = False
+            if failed and self.connected_to_cloud:
+                # El cloud responde pero no acepta (sobrecarga, error): no
+                # reintentar con el ritmo fijo de la ventana de envío
+                self._retry_at = time.time() + self._backoff_delay(self.send_failures)
+                self.send_failures += 1
+                logger.warning(f"Envío fallido, próximo intento en {self._retry_at - time.time():.1f} s")
+            elif sent:
+                self.send_failures = 0
+                self._retry_at = 0.0
+    
+    def _gateway_info(self):
+        """Datos de registro de este gateway"""
+        return {
+            'gateway_id': self.gateway_id,
+            'bluetooth_type': os.getenv('BLUETOOTH_TYPE', 'SPP'),
+            'device_name': os.getenv('BLE_DEVICE_NAME', 'Filsync-ESP32'),
+            'devices': [device['device_id'] for device in self.devices if device['device_id']],
+            'registered_at': datetime.now().isoformat()
+        }
+    
+    async def _register_gateway(self):
+        """Registra este gateway en el servidor cloud"""
+        try:
+            response = await self._post_to_cloud("/api/gateway/register", self._gateway_info(), timeout=10)
+            
+            if response.status == 200:
                 logger.info("✓ Gateway registrado en el servidor cloud")
                 self.connected_to_cloud = True
                 return True
             else:
-                logger.error(f"Error registrando gateway: {response.status_code}")
+                logger.error(f"Error registrando gateway: {response.status}")
                 return False
-                
+        
         except Exception as e:
-            logger.error(f"Error conectando al cloud: {e}")
+            logger.error(f"Error conectando al cloud: {e!r}")
+            return False
+    
+    async def _connect_socket(self):
+        """Abre el canal Socket.IO persistente (se registra al conectar)"""
+        if self.sio is None:
+            # La reconexión la lleva _reconnect_loop (mismo backoff que HTTP)
+            self.sio = socketio.AsyncClient(reconnection=False)
+            self.sio.on('connect', self._on_socket_connect, namespace=GATEWAY_NAMESPACE)
+            self.sio.on('disconnect', self._on_socket_disconnect, namespace=GATEWAY_NAMESPACE)
+            self.sio.on('control', self._apply_control, namespace=GATEWAY_NAMESPACE)
+        
+        try:
+            await self.sio.connect(
+                self.cloud_url,
+                namespaces=[GATEWAY_NAMESPACE],
+                auth={**self._gateway_info(), 'secret': self.secret_key},
+                wait_timeout=10
+            )
+            return True
+        except socketio.exceptions.ConnectionError as e:
+            logger.error(f"Error conectando socket al cloud: {e}")
             return False
     
-    def _ping_cloud(self):
-        """Envía ping periódico al servidor cloud"""
+    def _on_socket_connect(self):
+        """Canal Socket.IO abierto (también tras una reconexión)"""
+        logger.info("✓ Canal Socket.IO abierto con el servidor cloud")
+        self.connected_to_cloud = True
+        # Vaciar la cola en otra tarea: el handler no debe esperar a los acks
+        asyncio.create_task(self._flush_queue())
+    
+    def _on_socket_disconnect(self):
+        """Canal Socket.IO cerrado; _reconnect_loop vuelve a abrirlo"""
+        if self.connected_to_cloud:
+            logger.error("❌ Canal Socket.IO cerrado, reconectando...")
+        self.connected_to_cloud = False
+    
+    def _backoff_delay(self, attempts):
+        """Espera aleatoria entre 0 y base * 2^intentos (con tope): backoff con jitter completo"""
+        ceiling = min(self.reconnect_max, self.reconnect_base * 2 ** min(attempts, 30))
+        return random.uniform(0, ceiling)
+    
+    def _reconnect_delay(self):
+        """Espera antes del próximo intento de reconexión"""
+        delay = self._backoff_delay(self.reconnect_attempts)
+        self.reconnect_attempts += 1
+        return delay
+    
+    async def _reconnect_loop(self):
+        """Reconecta con el cloud cada vez que se pierde la conexión"""
+        while True:
+            await self._disconnected_event.wait()
+            
+            delay = self._reconnect_delay()
+            logger.info(f"🔄 Reintento de conexión con el cloud en {delay:.1f} s (intento {self.reconnect_attempts})")
+            try:
+                # Si otro envío recupera la conexión antes, no hace falta reintentar
+                await asyncio.wait_for(self._connected_event.wait(), delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            
+            try:
+                if self.transport == 'socketio':
+                    # Al abrir el canal, _on_socket_connect vacía la cola
+                    connected = await self._connect_socket()
+                else:
+                    connected = await self._register_gateway()
+                    if connected:
+                        asyncio.create_task(self._flush_queue())
+            except Exception as e:
+                logger.debug(f"Error reconectando: {e!r}")
+                connected = False
+            
+            if connected:
+                logger.info("✓ Reconectado al servidor cloud")
+    
+    async def _heartbeat(self):
+        """Envía ping periódico al servidor cloud (solo HTTP: el socket tiene el suyo)"""
         while True:
             try:
-                time.sleep(30)  # Ping cada 30 segundos
+                await asyncio.sleep(30)  # Ping cada 30 segundos
                 
-                if not self.connected_to_cloud:
-                    # Intentar reconectar
-                    if self._register_gateway():
-                        logger.info("✓ Reconectado al servidor cloud")
-                        self._flush_queue()  # Enviar datos pendientes
+                # Sin conexión reintenta _reconnect_loop
+                if self.transport == 'socketio' or not self.connected_to_cloud:
                     continue
                 
                 # Enviar ping
                 headers = {'X-Gateway-Secret': self.secret_key}
-                response = requests.get(
+                async with self.http.get(
                     f"{self.cloud_url}/api/gateway/ping",
                     headers=headers,
                     params={'gateway_id': self.gateway_id},
-                    timeout=5
-                )
+                    timeout=aiohttp.ClientTimeout(total=5)
+                ) as response:
+                    status = response.status
                 
-                if response.status_code != 200:
+                if status != 200:
                     self.connected_to_cloud = False
                     logger.warning("Ping falló, marcando como desconectado")
                 else:
                     self.last_ping = time.time()
-                    
+            
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.connected_to_cloud = False
+                logger.debug(f"Error en ping: {e!r}")
+    
+    async def _report_status(self):
+        """Muestra el estado cada 60 segundos"""
+        while True:
+            await asyncio.sleep(60 - time.time() % 60)
+            
+            status = "🟢 CONECTADO" if self.connected_to_cloud else "🔴 DESCONECTADO"
+            bt_connected = sum(1 for handler in self.bluetooth_handlers if handler.connected)
+            if len(self.bluetooth_handlers) > 1:
+                bt_status = f"{bt_connected}/{len(self.bluetooth_handlers)} sensores conectados"
+            else:
+                bt_status = "🟢 CONECTADO" if bt_connected else "🔴 DESCONECTADO"
+            suppressed = sum(deadband.suppressed for deadband in self.deadbands.values())
+            
+            queue_size = len(self.outbox)
+            
+            logger.info(f"\n📊 Estado: Cloud {status} | Bluetooth {bt_status} | Cola: {queue_size} datos pendientes"
+                        f" | Entrega: {self.handoff.qsize()} ({self.handoff_dropped} descartados)"
+                        + (f" | Banda muerta: {suppressed} omitidas" if self.deadband_thresholds else "")
+                        + (f" | Crudos en disco: {len(self.raw_store)}" if self.raw_store else ""))
+    
+    async def run(self):
+        """Conecta con el cloud y ejecuta todas las tareas del gateway en este loop"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.handoff = asyncio.Queue(maxsize=self.handoff_size)
+        self._connected_event = asyncio.Event()
+        self._disconnected_event = asyncio.Event()
+        self._disconnected_event.set()  # hasta la primera conexión
+        # Cada sensor SPP espera sus líneas en un hilo del pool por defecto:
+        # tiene que haber uno por sensor además de los de uso general
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=len(self.devices) + 4))
+        
+        # Conexiones keep-alive al cloud: una por lote en vuelo más el heartbeat
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_inflight + 1))
+        
+        tasks = []
+        try:
+            # Registrar en cloud
+            logger.info("🌐 Conectando al servidor cloud...")
+            if self.transport == 'socketio':
+                connected = await self._connect_socket()
+            else:
+                connected = await self._register_gateway()
+            
+            if connected:
+                logger.info("✓ Conexión establecida con el cloud")
+            else:
+                logger.warning("⚠️  No se pudo conectar al cloud (se reintentará automáticamente)")
+                logger.warning("    El gateway funcionará en modo offline y sincronizará cuando sea posible")
+            
+            # Tarea de envío (outbox + cloud), independiente de la lectura Bluetooth
+            tasks.append(asyncio.create_task(self._sender()))
+            
+            # Iniciar Bluetooth: una tarea de lectura por sensor
+            logger.info("\n📱 Iniciando conexión Bluetooth...")
+            try:
+                for device in self.devices:
+                    handler = BluetoothHandler(
+                        data_callback=functools.partial(self.on_bluetooth_data, device_id=device['device_id']),
+                        bt_type=device['bt_type'],
+                        port=device['port'],
+                        device_name=device['device_name']
+                    )
+                    self.bluetooth_handlers.append(handler)
+                    tasks.append(asyncio.create_task(handler.run()))
+                logger.info(f"✓ Bluetooth iniciado correctamente ({len(self.bluetooth_handlers)} sensores)")
             except Exception as e:
+                logger.error(f"❌ Error iniciando Bluetooth: {e}")
+                return
+            
+            tasks.append(asyncio.create_task(self._reconnect_loop()))
+            tasks.append(asyncio.create_task(self._heartbeat()))
+            tasks.append(asyncio.create_task(self._report_status()))
+            
+            logger.info("\n" + "=" * 60)
+            logger.info("🚀 GATEWAY EN EJECUCIÓN")
+            logger.info("=" * 60)
+            logger.info("Presiona Ctrl+C para detener\n")
+            
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for handler in self.bluetooth_handlers:
+                handler.stop()
+            if self.sio:
                 self.connected_to_cloud = False
-                logger.debug(f"Error en ping: {e}")
+                await self.sio.disconnect()
+            await self.http.close()
+            self.outbox.close()
+            if self.raw_store:
+                self.raw_store.close()
     
     def start(self):
         """Inicia el gateway"""
@@ -216,55 +1032,17 @@ class CloudGateway:
         logger.info("=" * 60)
         logger.info(f"\n📡 Servidor Cloud: {self.cloud_url}")
         logger.info(f"🔑 Gateway ID: {self.gateway_id}")
-        logger.info(f"🔵 Bluetooth Type: {os.getenv('BLUETOOTH_TYPE', 'SPP')}\n")
-        
-        # Registrar en cloud
-        logger.info("🌐 Conectando al servidor cloud...")
-        if self._register_gateway():
-            logger.info("✓ Conexión establecida con el cloud")
+        if any(device['device_id'] for device in self.devices):
+            logger.info(f"🔵 Sensores: {', '.join(device['device_id'] for device in self.devices)}")
         else:
-            logger.warning("⚠️  No se pudo conectar al cloud (se reintentará automáticamente)")
-            logger.warning("    El gateway funcionará en modo offline y sincronizará cuando sea posible")
-        
-        # Iniciar Bluetooth
-        logger.info("\n📱 Iniciando conexión Bluetooth...")
-        try:
-            self.bluetooth_handler = BluetoothHandler(data_callback=self.on_bluetooth_data)
-            self.bluetooth_handler.start()
-            logger.info("✓ Bluetooth iniciado correctamente")
-        except Exception as e:
-            logger.error(f"❌ Error iniciando Bluetooth: {e}")
-            return
-        
-        # Iniciar hilo de ping
-        ping_thread = threading.Thread(target=self._ping_cloud, daemon=True)
-        ping_thread.start()
-        
-        logger.info("\n" + "=" * 60)
-        logger.info("🚀 GATEWAY EN EJECUCIÓN")
-        logger.info("=" * 60)
-        logger.info("Presiona Ctrl+C para detener\n")
+            logger.info(f"🔵 Bluetooth Type: {os.getenv('BLUETOOTH_TYPE', 'SPP')}")
+        logger.info(f"🔌 Transporte: {self.transport}\n")
         
-        # Mantener ejecutando
         try:
-            while True:
-                time.sleep(1)
-                
-                # Mostrar estado cada 60 segundos
-                if int(time.time()) % 60 == 0:
-                    status = "🟢 CONECTADO" if self.connected_to_cloud else "🔴 DESCONECTADO"
-                    bt_status = "🟢 CONECTADO" if self.bluetooth_handler.connected else "🔴 DESCONECTADO"
-                    
-                    with self.queue_lock:
-                        queue_size = len(self.data_queue)
-                    
-                    logger.info(f"\n📊 Estado: Cloud {status} | Bluetooth {bt_status} | Cola: {queue_size} datos pendientes")
-                    
+            asyncio.run(self.run())
         except KeyboardInterrupt:
             logger.info("\n\n⏹️  Deteniendo gateway...")
-            if self.bluetooth_handler:
-                self.bluetooth_handler.stop()
-            logger.info("✓ Gateway detenido\n")
+        logger.info("✓ Gateway detenido\n")
 
 
 def main():
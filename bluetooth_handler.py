@@ -1,7 +1,9 @@
+import asyncio
 import threading
 import time
 import logging
 import re
+from collections import deque
 from datetime import datetime
 from config import Config
 
@@ -36,11 +38,11 @@ class BiometricData:
         self.timestamp = datetime.now().timestamp()
         self.lock = threading.Lock()
 
-        # Buffers para gráficas
-        self.fc_buffer = []
-        self.spo2_buffer = []
-        self.temp_buffer = []
-        self.timestamps = []
+        # Buffers para gráficas (solo uso local, no se envían al cloud)
+        self.fc_buffer = deque(maxlen=Config.MAX_DATA_POINTS)
+        self.spo2_buffer = deque(maxlen=Config.MAX_DATA_POINTS)
+        self.temp_buffer = deque(maxlen=Config.MAX_DATA_POINTS)
+        self.timestamps = deque(maxlen=Config.MAX_DATA_POINTS)
 
     def update(self, key, value):
         """Actualiza un valor y su buffer"""
@@ -66,15 +68,11 @@ class BiometricData:
                 self._infer_state()
 
     def _add_to_buffer(self, buffer, value):
-        """Añade valor al buffer y mantiene el tamaño máximo"""
+        """Añade valor al buffer (los deque descartan solos el más viejo)"""
         buffer.append(value)
-        if len(buffer) > Config.MAX_DATA_POINTS:
-            buffer.pop(0)
 
         # Sincronizar timestamps
         self.timestamps.append(datetime.now().strftime('%H:%M:%S'))
-        if len(self.timestamps) > Config.MAX_DATA_POINTS:
-            self.timestamps.pop(0)
 
     def _infer_state(self):
         """Inferir estado basado en FC (Opción B - fallback)"""
@@ -87,8 +85,20 @@ class BiometricData:
         else:
             self.state = "STRESS"
 
+    def get_point(self):
+        """Lectura actual sin buffers: lo que se envía por cada muestra"""
+        with self.lock:
+            return {
+                'fc': self.fc,
+                'spo2': self.spo2,
+                'temp': round(self.temp, 2),
+                'state': self.state,
+                'ir': self.ir,
+                'timestamp': self.timestamp
+            }
+
     def get_dict(self):
-        """Retorna datos como diccionario"""
+        """Retorna datos como diccionario (con copia de los buffers)"""
         with self.lock:
             return {
                 'fc': self.fc,
@@ -98,23 +108,41 @@ class BiometricData:
                 'ir': self.ir,
                 'timestamp': self.timestamp,
                 'buffers': {
-                    'fc': self.fc_buffer.copy(),
-                    'spo2': self.spo2_buffer.copy(),
+                    'fc': list(self.fc_buffer),
+                    'spo2': list(self.spo2_buffer),
                     'temp': [round(t, 2) for t in self.temp_buffer],
-                    'timestamps': self.timestamps.copy()
+                    'timestamps': list(self.timestamps)
                 }
             }
 
 
 class BluetoothHandler:
-    """Manejador de conexión Bluetooth (SPP o BLE)"""
-
-    def __init__(self, data_callback=None):
+    """Manejador de conexión Bluetooth (SPP o BLE) de un sensor"""
+
+    # Escaneo BLE compartido: con varios sensores BLE en el mismo proceso solo
+    # uno escanea a la vez y los demás reutilizan el resultado reciente
+    _scan_lock = None
+    _scan_result = (0.0, [])
+    # Direcciones BLE ya conectadas por algún manejador
+    _ble_claimed = set()
+
+    def __init__(self, data_callback=None, bt_type=None, port=None, device_name=None):
+        """
+        Args:
+            data_callback: Función que recibe cada lectura (dict)
+            bt_type: 'SPP' o 'BLE' (por defecto Config.BLUETOOTH_TYPE)
+            port: Puerto serie SPP (por defecto Config.BLUETOOTH_PORT)
+            device_name: Nombre o dirección BLE (por defecto Config.BLE_DEVICE_NAME)
+        """
         self.data = BiometricData()
         self.data_callback = data_callback
+        self.bt_type = (bt_type or Config.BLUETOOTH_TYPE).upper()
+        self.port = port or Config.BLUETOOTH_PORT
+        self.device_name = device_name or Config.BLE_DEVICE_NAME
         self.running = False
         self.connected = False
         self.connection = None
+        self.ble_address = None
         self.thread = None
 
         # Patrones de regex para parsear datos
@@ -135,16 +163,41 @@ class BluetoothHandler:
 
         self.running = True
 
-        if Config.BLUETOOTH_TYPE == 'SPP':
+        if self.bt_type == 'SPP':
             self.thread = threading.Thread(target=self._run_spp, daemon=True)
-        elif Config.BLUETOOTH_TYPE == 'BLE':
+        elif self.bt_type == 'BLE':
             self.thread = threading.Thread(target=self._run_ble_wrapper, daemon=True)
         else:
-            logger.error(f"Tipo de Bluetooth no válido: {Config.BLUETOOTH_TYPE}")
+            logger.error(f"Tipo de Bluetooth no válido: {self.bt_type}")
             return
 
         self.thread.start()
-        logger.info(f"Bluetooth iniciado en modo {Config.BLUETOOTH_TYPE}")
+        logger.info(f"Bluetooth iniciado en modo {self.bt_type}")
+
+    async def run(self):
+        """
+        Lectura Bluetooth como tarea del event loop del llamador (alternativa
+        a start() sin hilo propio)
+
+        BLE corre directamente en el loop; SPP espera cada línea del puerto
+        serie en un hilo auxiliar, sin sondeo con sleep.
+        """
+        if self.running:
+            logger.warning("Bluetooth ya está ejecutándose")
+            return
+
+        self.running = True
+        logger.info(f"Bluetooth iniciado en modo {self.bt_type}")
+
+        if self.bt_type == 'SPP':
+            await self._run_spp_async()
+        elif self.bt_type == 'BLE':
+            if not BLEAK_AVAILABLE:
+                logger.error("bleak no está instalado. Instala con: pip install bleak")
+                return
+            await self._run_ble()
+        else:
+            logger.error(f"Tipo de Bluetooth no válido: {self.bt_type}")
 
     def stop(self):
         """Detiene la conexión Bluetooth"""
@@ -153,7 +206,7 @@ class BluetoothHandler:
 
         if self.connection:
             try:
-                if Config.BLUETOOTH_TYPE == 'SPP' and hasattr(self.connection, 'close'):
+                if self.bt_type == 'SPP' and hasattr(self.connection, 'close'):
                     self.connection.close()
             except Exception as e:
                 logger.error(f"Error al cerrar conexión: {e}")
@@ -169,14 +222,14 @@ class BluetoothHandler:
         while self.running:
             try:
                 if not self.connected:
-                    logger.info(f"Conectando a {Config.BLUETOOTH_PORT}...")
+                    logger.info(f"Conectando a {self.port}...")
                     self.connection = serial.Serial(
-                        Config.BLUETOOTH_PORT,
+                        self.port,
                         baudrate=115200,
                         timeout=2
                     )
                     self.connected = True
-                    logger.info(f"✓ Conectado a {Config.BLUETOOTH_PORT}")
+                    logger.info(f"✓ Conectado a {self.port}")
 
                 # Leer línea del puerto serial
                 if self.connection.in_waiting > 0:
@@ -205,6 +258,50 @@ class BluetoothHandler:
                 logger.error(f"Error inesperado: {e}", exc_info=True)
                 time.sleep(5)
 
+    async def _run_spp_async(self):
+        """Lectura Bluetooth Classic SPP desde un event loop"""
+        if not SERIAL_AVAILABLE:
+            logger.error("pyserial no está instalado. Instala con: pip install pyserial")
+            return
+
+        while self.running:
+            try:
+                if not self.connected:
+                    logger.info(f"Conectando a {self.port}...")
+                    self.connection = await asyncio.to_thread(
+                        serial.Serial,
+                        self.port,
+                        baudrate=115200,
+                        timeout=2
+                    )
+                    self.connected = True
+                    logger.info(f"✓ Conectado a {self.port}")
+
+                # readline espera como mucho el timeout del puerto (2 s)
+                raw = await asyncio.to_thread(self.connection.readline)
+                line = raw.decode('utf-8', errors='ignore').strip()
+                if line:
+                    self._parse_line(line)
+
+            except serial.SerialException as e:
+                if self.connected:
+                    logger.error(f"Conexión perdida: {e}")
+                    self.connected = False
+
+                if self.connection:
+                    try:
+                        self.connection.close()
+                    except:
+                        pass
+                    self.connection = None
+
+                logger.info("Reintentando conexión en 5 segundos...")
+                await asyncio.sleep(5)
+
+            except Exception as e:
+                logger.error(f"Error inesperado: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
     def _run_ble_wrapper(self):
         """Wrapper para ejecutar asyncio en un hilo"""
         if not BLEAK_AVAILABLE:
@@ -227,25 +324,29 @@ class BluetoothHandler:
         while self.running:
             try:
                 if not self.connected:
-                    logger.info(f"Buscando dispositivo BLE: {Config.BLE_DEVICE_NAME}...")
+                    logger.info(f"Buscando dispositivo BLE: {self.device_name}...")
 
-                    # Escanear dispositivos
-                    devices = await BleakScanner.discover(timeout=10.0)
+                    # Escanear dispositivos (por nombre o por dirección)
+                    devices = await self._discover()
                     device = None
 
                     for d in devices:
-                        if d.name and Config.BLE_DEVICE_NAME in d.name:
+                        if d.address in BluetoothHandler._ble_claimed:
+                            continue
+                        if d.address.upper() == self.device_name.upper() or (d.name and self.device_name in d.name):
                             device = d
                             break
 
                     if not device:
-                        logger.warning(f"No se encontró {Config.BLE_DEVICE_NAME}")
+                        logger.warning(f"No se encontró {self.device_name}")
                         await asyncio.sleep(5)
                         continue
 
                     logger.info(f"Dispositivo encontrado: {device.name} ({device.address})")
 
                     # Conectar al dispositivo
+                    self.ble_address = device.address
+                    BluetoothHandler._ble_claimed.add(device.address)
                     async with BleakClient(device.address) as client:
                         self.connected = True
                         logger.info("✓ Conectado vía BLE")
@@ -281,11 +382,34 @@ class BluetoothHandler:
 
                         await client.stop_notify(Config.BLE_CHAR_UUID)
 
+                    # Desconectado: volver a buscarlo
+                    self.connected = False
+                    self._release_ble()
+
             except Exception as e:
                 logger.error(f"Error BLE: {e}")
                 self.connected = False
+                self._release_ble()
                 await asyncio.sleep(5)
 
+    async def _discover(self):
+        """Escanea dispositivos BLE, reutilizando un escaneo de hace menos de 5 s"""
+        if BluetoothHandler._scan_lock is None:
+            BluetoothHandler._scan_lock = asyncio.Lock()
+
+        async with BluetoothHandler._scan_lock:
+            scanned_at, devices = BluetoothHandler._scan_result
+            if time.monotonic() - scanned_at > 5:
+                devices = await BleakScanner.discover(timeout=10.0)
+                BluetoothHandler._scan_result = (time.monotonic(), devices)
+        return devices
+
+    def _release_ble(self):
+        """Libera la dirección BLE para que otro manejador pueda usarla"""
+        if self.ble_address:
+            BluetoothHandler._ble_claimed.discard(self.ble_address)
+            self.ble_address = None
+
     def _parse_line(self, line):
         """Parsea una línea recibida del ESP32"""
         # Solo log en modo debug para reducir overhead
@@ -306,7 +430,7 @@ class BluetoothHandler:
         # Llamar callback SOLO si encontramos datos válidos
         if found_any and self.data_callback:
             try:
-                self.data_callback(self.data.get_dict())
+                self.data_callback(self.data.get_point())
             except Exception as e:
                 logger.error(f"Error en callback: {e}")
 
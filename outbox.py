@@ -0,0 +1,142 @@
+"""
+Outbox persistente del gateway
+==============================
+Cola en disco (SQLite en modo WAL) de lecturas pendientes de enviar al
+cloud. Sustituye a la lista en memoria: sobrevive a reinicios y caídas del
+gateway, y la memoria no crece aunque el cloud esté días sin responder.
+
+Cada lectura recibe un número de secuencia creciente (`seq`). Se leen en
+orden con `peek()` y solo se borran cuando el cloud las confirma con
+`ack()`. Las seq solo son únicas dentro de una base de datos: al crearla se
+genera una época (`epoch`) que viaja con cada lote, así el cloud no confunde
+las seq de un outbox nuevo con las ya vistas del anterior. El tamaño está acotado por número de entradas y por antigüedad;
+al superarlo se descartan las más viejas.
+
+Solo usa la librería estándar (sqlite3).
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Cola FIFO persistente con confirmación por entrada"""
+
+    # Cada cuántas inserciones se aplican los límites de tamaño y antigüedad
+    TRIM_EVERY = 1000
+
+    def __init__(self, path='gateway_outbox.db', max_entries=1_000_000, retention=7 * 86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.retention = retention
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._since_trim = 0
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # NORMAL en WAL: una caída del proceso no pierde nada; un corte de
+        # luz como mucho las últimas transacciones
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'created REAL NOT NULL, '
+            'data TEXT NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex,))
+        self.epoch = self._db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        self._count = self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        self._trim()
+
+        if self._count:
+            logger.info(f"📦 Outbox: {self._count} lecturas pendientes de la sesión anterior")
+
+    def __len__(self):
+        return self._count
+
+    def append(self, data):
+        """Añade una lectura y retorna su seq"""
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO outbox (created, data) VALUES (?, ?)',
+                (time.time(), json.dumps(data, separators=(',', ':')))
+            )
+            self._count += 1
+            self._since_trim += 1
+            if self._since_trim >= self.TRIM_EVERY or self._count > self.max_entries:
+                self._trim()
+            return cursor.lastrowid
+
+    def replace(self, seq, data):
+        """Sustituye el contenido de una entrada pendiente; False si ya no está"""
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE outbox SET data = ? WHERE seq = ?',
+                (json.dumps(data, separators=(',', ':')), seq)
+            )
+            return cursor.rowcount > 0
+
+    def peek(self, limit, after=0):
+        """Primeras `limit` lecturas pendientes con seq > `after`, como lista de (seq, data)"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT seq, data FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit)
+            ).fetchall()
+        return [(seq, json.loads(data)) for seq, data in rows]
+
+    def between(self, start, end, limit, after=0):
+        """Lecturas guardadas entre start y end (Unix), en orden y con seq > `after`"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT seq, data FROM outbox WHERE created BETWEEN ? AND ? AND seq > ? ORDER BY seq LIMIT ?',
+                (start, end, after, limit)
+            ).fetchall()
+        return [(seq, json.loads(data)) for seq, data in rows]
+
+    def ack(self, seqs):
+        """Borra las entradas confirmadas por el cloud"""
+        if not seqs:
+            return
+        with self._lock:
+            cursor = self._db.executemany('DELETE FROM outbox WHERE seq = ?', ((seq,) for seq in seqs))
+            self._count -= max(0, cursor.rowcount)
+
+    def ack_range(self, first, last):
+        """Borra las entradas con first <= seq <= last (un lote confirmado)"""
+        if first > last:
+            return
+        with self._lock:
+            cursor = self._db.execute('DELETE FROM outbox WHERE seq BETWEEN ? AND ?', (first, last))
+            self._count -= max(0, cursor.rowcount)
+
+    def _trim(self):
+        """Aplica retención y tamaño máximo descartando lo más viejo (requiere self._lock)"""
+        self._since_trim = 0
+        removed = self._db.execute(
+            'DELETE FROM outbox WHERE created < ?', (time.time() - self.retention,)
+        ).rowcount
+
+        excess = self._count - removed - self.max_entries
+        if excess > 0:
+            removed += self._db.execute(
+                'DELETE FROM outbox WHERE seq IN (SELECT seq FROM outbox ORDER BY seq LIMIT ?)',
+                (excess,)
+            ).rowcount
+
+        if removed > 0:
+            self._count -= removed
+            self.dropped += removed
+            logger.warning(f"📦 Outbox lleno o con datos caducados: {removed} lecturas descartadas")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
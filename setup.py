@@ -83,6 +83,7 @@ def install_requirements():
         'Flask-SocketIO==5.3.5',
         'Flask-CORS==4.0.0',
         'python-socketio==5.10.0',
+        'aiohttp==3.9.1',
         'pyserial==3.5',
         'requests==2.31.0',
         'python-dotenv==1.0.0',
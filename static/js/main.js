@@ -2,7 +2,9 @@
 const CONFIG = {
     maxDataPoints: 50,
     chartUpdateInterval: 1000,
-    tipsDebounceTime: 5000
+    tipsDebounceTime: 5000,
+    aiJobPollInterval: 3000,
+    aiJobTimeout: 60000
 };
 
 // Estado global
@@ -11,6 +13,14 @@ let charts = {};
 let lastStressTime = 0;
 let tipsShown = false;
 
+// Trabajos de IA en curso (job_id -> resolver) y resultados que llegaron antes
+const pendingAIJobs = {};
+const earlyAIResults = {};
+
+// Chat en streaming (job_id -> callback) y fragmentos que llegaron antes
+const tokenHandlers = {};
+const earlyTokens = {};
+
 // Elementos del DOM
 const elements = {
     connectionStatus: document.getElementById('connectionStatus'),
@@ -64,6 +74,34 @@ function initializeWebSocket() {
         updateUI(data);
     });
 
+    socket.on('nueva_alerta', (alert) => {
+        // Al empezar un episodio de estrés el servidor ya pidió los consejos
+        if (alert.tips || alert.tips_job_id) {
+            showPrefetchedTips(alert);
+        }
+    });
+
+    socket.on('ai_result', (payload) => {
+        const resolve = pendingAIJobs[payload.job_id];
+        if (resolve) {
+            resolve(payload.result);
+        } else {
+            // Los resultados llegan a todos los clientes: si nadie lo reclama
+            // a tiempo (trabajo de otro cliente) se descarta
+            earlyAIResults[payload.job_id] = payload.result;
+            setTimeout(() => delete earlyAIResults[payload.job_id], CONFIG.aiJobTimeout);
+        }
+    });
+
+    socket.on('chat_token', (payload) => {
+        const handler = tokenHandlers[payload.job_id];
+        if (handler) {
+            handler(payload.token);
+        } else {
+            (earlyTokens[payload.job_id] = earlyTokens[payload.job_id] || []).push(payload.token);
+        }
+    });
+
     socket.on('connect_error', (error) => {
         console.error('Error de conexión:', error);
         updateConnectionStatus(false);
@@ -248,7 +286,7 @@ function checkAndShowAITips(data) {
     }
 }
 
-async function requestAITips(data) {
+function showTipsLoading() {
     elements.aiTips.style.display = 'block';
     elements.tipsContent.innerHTML = `
         <div class="loading">
@@ -256,30 +294,32 @@ async function requestAITips(data) {
         </div>
     `;
     tipsShown = true;
+}
+
+async function showPrefetchedTips(alert) {
+    // Evita que checkAndShowAITips pida los mismos consejos otra vez
+    lastStressTime = Date.now();
+    showTipsLoading();
 
     try {
-        const response = await fetch('/api/ai_tips', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                fc: data.fc,
-                spo2: data.spo2,
-                temp: data.temp,
-                state: data.state
-            })
-        });
+        showTipsResult(alert.tips || await waitForAIJob(alert.tips_job_id));
+    } catch (error) {
+        console.error('Error recibiendo consejos:', error);
+    }
+}
 
-        const result = await response.json();
+async function requestAITips(data) {
+    showTipsLoading();
 
-        if (result.success) {
-            elements.tipsContent.innerHTML = formatTips(result.tips);
-        } else {
-            elements.tipsContent.innerHTML = `
-                <p><i class="fas fa-exclamation-circle"></i> ${result.error || 'No se pudieron generar consejos'}</p>
-            `;
-        }
+    try {
+        const result = await postAIJob('/api/ai_tips', {
+            fc: data.fc,
+            spo2: data.spo2,
+            temp: data.temp,
+            state: data.state
+        });
+
+        showTipsResult(result);
     } catch (error) {
         console.error('Error solicitando consejos:', error);
         elements.tipsContent.innerHTML = `
@@ -288,6 +328,85 @@ async function requestAITips(data) {
     }
 }
 
+function showTipsResult(result) {
+    if (!tipsShown) return;
+
+    if (result.success) {
+        elements.tipsContent.innerHTML = formatTips(result.tips);
+    } else {
+        elements.tipsContent.innerHTML = `
+            <p><i class="fas fa-exclamation-circle"></i> ${result.error || 'No se pudieron generar consejos'}</p>
+        `;
+    }
+}
+
+// ============================================
+// Trabajos de IA (respuesta por Socket.IO o consulta periódica)
+// ============================================
+
+async function postAIJob(url, body, onToken = null) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ ...body, sid: socket ? socket.id : null })
+    });
+
+    const result = await response.json();
+
+    // Sin job_id la respuesta ya es el resultado (caché o error)
+    if (!result.job_id) return result;
+
+    if (onToken) {
+        (earlyTokens[result.job_id] || []).forEach(onToken);
+        delete earlyTokens[result.job_id];
+        tokenHandlers[result.job_id] = onToken;
+    }
+
+    try {
+        return await waitForAIJob(result.job_id);
+    } finally {
+        delete tokenHandlers[result.job_id];
+    }
+}
+
+function waitForAIJob(jobId) {
+    if (jobId in earlyAIResults) {
+        const result = earlyAIResults[jobId];
+        delete earlyAIResults[jobId];
+        return Promise.resolve(result);
+    }
+
+    return new Promise((resolve) => {
+        const started = Date.now();
+
+        const finish = (result) => {
+            clearInterval(poll);
+            delete pendingAIJobs[jobId];
+            resolve(result);
+        };
+
+        // Respaldo por si el evento se pierde (socket caído o reconectado)
+        const poll = setInterval(async () => {
+            if (Date.now() - started > CONFIG.aiJobTimeout) {
+                finish({ success: false, error: 'La solicitud tardó demasiado. Intenta nuevamente.' });
+                return;
+            }
+
+            try {
+                const response = await fetch(`/api/ai_jobs/${jobId}`);
+                const job = await response.json();
+                if (job.status === 'done') finish(job.result);
+            } catch (error) {
+                console.error('Error consultando trabajo de IA:', error);
+            }
+        }, CONFIG.aiJobPollInterval);
+
+        pendingAIJobs[jobId] = finish;
+    });
+}
+
 function formatTips(tips) {
     // Convertir texto en HTML formateado
     return tips
@@ -337,22 +456,28 @@ async function sendMessage() {
     // Mostrar indicador de escritura
     const typingId = addChatMessage('Escribiendo...', 'assistant', true);
 
-    try {
-        const response = await fetch('/api/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ message })
-        });
+    // Con socket conectado la respuesta llega fragmento a fragmento
+    let streamId = null;
+    let streamText = '';
+    const onToken = (token) => {
+        if (!streamId) {
+            document.getElementById(typingId)?.remove();
+            streamId = addChatMessage('', 'assistant');
+        }
+        streamText += token;
+        document.getElementById(streamId).querySelector('.message-content').textContent = streamText;
+        elements.chatMessages.scrollTop = elements.chatMessages.scrollHeight;
+    };
+    const stream = Boolean(socket && socket.connected);
 
-        const result = await response.json();
+    try {
+        const result = await postAIJob('/api/chat', { message, stream }, stream ? onToken : null);
 
         // Remover indicador de escritura
         document.getElementById(typingId)?.remove();
 
         if (result.success) {
-            addChatMessage(result.response, 'assistant');
+            if (!streamId) addChatMessage(result.response, 'assistant');
         } else {
             addChatMessage(
                 `Error: ${result.error || 'No se pudo procesar el mensaje'}`,
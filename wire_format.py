@@ -0,0 +1,220 @@
+"""
+Formato binario compacto gateway → cloud
+========================================
+Alternativa a JSON para enviar lecturas biométricas. Se negocia con
+`Content-Type: application/x-filsync-samples` y lo entienden tanto
+`CloudGateway` como los endpoints de ingesta de `app.py`.
+
+Estructura (little-endian):
+
+    Cabecera:  magic 'FS' | versión u8 | flags u8 | n_muestras u32
+               | len(gateway_id) u8 | gateway_id utf-8
+               [| n_sensores u8 | (len u8 | device_id utf-8) x n
+                                               si flags & FLAG_DEVICE]
+               [| len u8 | epoch utf-8         si flags & FLAG_EPOCH]
+    Muestra:   timestamp f64 | fc u16 | spo2 u8 | temp_centi i16
+               | state u8 | ir u32                      (18 bytes)
+               [| seq u64                   si flags & FLAG_SEQ]
+               [| held u16 | held_until f64 si flags & FLAG_HELD]
+               [| índice del sensor u8      si flags & FLAG_DEVICE]
+
+La versión 1 no lleva flags (el decodificador original los ignoraba); los
+cuerpos con flags van como versión 2, así un servidor antiguo responde 415 y
+el gateway vuelve a JSON en vez de leer mal las muestras. Un flag
+desconocido también se rechaza como versión no soportada.
+
+Solo usa la librería estándar (struct), así el gateway no necesita
+dependencias adicionales.
+"""
+
+import struct
+
+CONTENT_TYPE = 'application/x-filsync-samples'
+
+MAGIC = b'FS'
+VERSION = 2
+VERSION_PLAIN = 1  # cuerpos sin flags, legibles por decodificadores de la versión 1
+
+HEADER = struct.Struct('<2sBBIB')
+SAMPLE = struct.Struct('<dHBhBI')
+
+# Flags de la cabecera
+FLAG_SEQ = 0x01   # cada muestra lleva su número de secuencia del gateway
+FLAG_HELD = 0x02  # cada muestra lleva las lecturas repetidas que omitió el gateway
+FLAG_DEVICE = 0x04  # tabla de sensores tras la cabecera y su índice en cada muestra
+FLAG_EPOCH = 0x08   # época del outbox del gateway (las seq solo son únicas dentro de ella)
+_SAMPLE_FLAGS = FLAG_SEQ | FLAG_HELD | FLAG_DEVICE
+_KNOWN_FLAGS = _SAMPLE_FLAGS | FLAG_EPOCH
+
+# Estructura de la muestra para cada combinación de flags
+_SAMPLE_STRUCTS = {
+    flags: struct.Struct(
+        SAMPLE.format
+        + ('Q' if flags & FLAG_SEQ else '')
+        + ('Hd' if flags & FLAG_HELD else '')
+        + ('B' if flags & FLAG_DEVICE else '')
+    )
+    for flags in range(_SAMPLE_FLAGS + 1)
+}
+
+# El índice de cada estado es su código en el formato binario
+STATES = ('SIN_DEDO', 'RELAX', 'NORMAL', 'STRESS')
+_STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+
+class WireFormatError(ValueError):
+    """Cuerpo binario mal formado"""
+
+
+class UnsupportedVersionError(WireFormatError):
+    """Cuerpo binario de una versión que este lado no entiende"""
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def encode_samples(samples, gateway_id=''):
+    """
+    Codifica una lista de lecturas en el formato binario
+
+    Args:
+        samples: Lista de dicts con fc, spo2, temp, state, ir y timestamp (Unix);
+            si todas llevan 'seq' se incluye en el cuerpo, igual que 'held' y
+            'held_until' o 'device_id' (hasta 255 sensores) si alguna los lleva;
+            el 'epoch' de la primera muestra va una vez en la cabecera
+        gateway_id: ID del gateway que envía el lote
+
+    Returns:
+        bytes: Cabecera + muestras
+    """
+    flags = 0
+    if samples and all('seq' in sample for sample in samples):
+        flags |= FLAG_SEQ
+    if any('held' in sample for sample in samples):
+        flags |= FLAG_HELD
+    devices = {}
+    for sample in samples:
+        if sample.get('device_id') is not None:
+            devices.setdefault(str(sample['device_id']), len(devices))
+    if len(devices) > 255:
+        raise WireFormatError('Demasiados sensores en un lote (máximo 255)')
+    if devices:
+        flags |= FLAG_DEVICE
+    epoch = str(samples[0].get('epoch') or '') if samples else ''
+    if epoch:
+        flags |= FLAG_EPOCH
+    sample_struct = _SAMPLE_STRUCTS[flags & _SAMPLE_FLAGS]
+    version = VERSION if flags else VERSION_PLAIN
+
+    gateway_bytes = gateway_id.encode('utf-8')[:255]
+    out = bytearray(HEADER.pack(MAGIC, version, flags, len(samples), len(gateway_bytes)))
+    out += gateway_bytes
+    if devices:
+        out.append(len(devices))
+        for device_id in devices:
+            device_bytes = device_id.encode('utf-8')[:255]
+            out.append(len(device_bytes))
+            out += device_bytes
+    if epoch:
+        epoch_bytes = epoch.encode('utf-8')[:255]
+        out.append(len(epoch_bytes))
+        out += epoch_bytes
+
+    for sample in samples:
+        fields = [
+            float(sample.get('timestamp', 0.0)),
+            _clamp(int(sample.get('fc', 0)), 0, 0xFFFF),
+            _clamp(int(sample.get('spo2', 0)), 0, 0xFF),
+            _clamp(round(float(sample.get('temp', 0.0)) * 100), -0x8000, 0x7FFF),
+            _STATE_CODES.get(str(sample.get('state', 'SIN_DEDO')).upper(), 0),
+            _clamp(int(sample.get('ir', 0)), 0, 0xFFFFFFFF)
+        ]
+        if flags & FLAG_SEQ:
+            fields.append(int(sample['seq']))
+        if flags & FLAG_HELD:
+            fields.append(_clamp(int(sample.get('held', 0)), 0, 0xFFFF))
+            fields.append(float(sample.get('held_until') or 0.0))
+        if flags & FLAG_DEVICE:
+            # Las muestras sin sensor usan el índice 255
+            device_id = sample.get('device_id')
+            fields.append(devices[str(device_id)] if device_id is not None else 255)
+        out += sample_struct.pack(*fields)
+
+    return bytes(out)
+
+
+def decode_samples(body):
+    """
+    Decodifica un cuerpo binario
+
+    Returns:
+        tuple: (gateway_id, lista de dicts con el mismo formato que la versión JSON)
+
+    Raises:
+        WireFormatError: Si la cabecera o el tamaño no cuadran
+        UnsupportedVersionError: Si la versión o algún flag no se conocen
+    """
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise WireFormatError('Cuerpo binario demasiado corto')
+
+    magic, version, flags, count, id_len = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise WireFormatError('Magic inválido')
+    if version not in (VERSION_PLAIN, VERSION):
+        raise UnsupportedVersionError(f'Versión de formato no soportada: {version}')
+    if flags & ~_KNOWN_FLAGS or (flags and version == VERSION_PLAIN):
+        raise UnsupportedVersionError(f'Flags de formato no soportados: {flags:#04x}')
+
+    sample_struct = _SAMPLE_STRUCTS[flags & _SAMPLE_FLAGS]
+    offset = HEADER.size + id_len
+    gateway_id = bytes(view[HEADER.size:offset]).decode('utf-8', errors='replace')
+
+    devices = []
+    if flags & FLAG_DEVICE:
+        if len(view) <= offset:
+            raise WireFormatError('Falta la tabla de sensores')
+        n_devices = view[offset]
+        offset += 1
+        for _ in range(n_devices):
+            if len(view) <= offset or len(view) < offset + 1 + view[offset]:
+                raise WireFormatError('Tabla de sensores incompleta')
+            end = offset + 1 + view[offset]
+            devices.append(bytes(view[offset + 1:end]).decode('utf-8', errors='replace'))
+            offset = end
+
+    epoch = None
+    if flags & FLAG_EPOCH:
+        if len(view) <= offset or len(view) < offset + 1 + view[offset]:
+            raise WireFormatError('Falta la época del outbox')
+        end = offset + 1 + view[offset]
+        epoch = bytes(view[offset + 1:end]).decode('utf-8', errors='replace')
+        offset = end
+
+    if len(view) != offset + count * sample_struct.size:
+        raise WireFormatError('Tamaño del cuerpo no coincide con el número de muestras')
+
+    samples = []
+    for timestamp, fc, spo2, temp_centi, state, ir, *extra in sample_struct.iter_unpack(view[offset:]):
+        sample = {
+            'fc': fc,
+            'spo2': spo2,
+            'temp': temp_centi / 100,
+            'state': STATES[state] if state < len(STATES) else 'SIN_DEDO',
+            'ir': ir,
+            'timestamp': timestamp
+        }
+        if flags & FLAG_SEQ:
+            sample['seq'] = extra.pop(0)
+        if epoch:
+            sample['epoch'] = epoch
+        if flags & FLAG_HELD:
+            held, held_until = extra.pop(0), extra.pop(0)
+            if held:
+                sample['held'], sample['held_until'] = held, held_until
+        if flags & FLAG_DEVICE and extra[0] < len(devices):
+            sample['device_id'] = devices[extra[0]]
+        samples.append(sample)
+
+    return gateway_id, samples